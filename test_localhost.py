@@ -1,4 +1,4 @@
-import os, sh, shutil, tempfile, io
+import os, sh, sys, shutil, tempfile, subprocess, io, asyncio, binascii, zlib, struct, pytest
 
 import ygit
 
@@ -33,7 +33,7 @@ def test_clone():
   with tempfile.TemporaryDirectory() as td:
     ygit.clone('http://localhost:8889/'+os.path.basename(d),td)
     assert sorted(os.listdir(td)) == ['.ygit', 'test.txt']
-    assert sorted([s for s in os.listdir(os.path.join(td,'.ygit')) if not s.endswith('.pack')]) == ['config', 'idx', 'refs']
+    assert sorted([s for s in os.listdir(os.path.join(td,'.ygit')) if not s.endswith('.pack')]) == ['config', 'idx', 'manifest', 'packed-refs', 'shallow']
     assert len([s for s in os.listdir(os.path.join(td,'.ygit')) if s.endswith('.pack')]) == 1
     with open(os.path.join(td,'test.txt')) as f:
       assert f.read()=='woot!'
@@ -57,7 +57,7 @@ def test_deep_clone():
   with tempfile.TemporaryDirectory() as td:
     ygit.clone('http://localhost:8889/'+os.path.basename(d),td, shallow=False)
     assert sorted(os.listdir(td)) == ['.ygit', 'subdir', 'test.txt']
-    assert sorted([s for s in os.listdir(os.path.join(td,'.ygit')) if not s.endswith('.pack')]) == ['config', 'idx', 'refs']
+    assert sorted([s for s in os.listdir(os.path.join(td,'.ygit')) if not s.endswith('.pack')]) == ['config', 'idx', 'manifest', 'packed-refs']
     assert len([s for s in os.listdir(os.path.join(td,'.ygit')) if s.endswith('.pack')]) == 1
     with open(os.path.join(td,'test.txt')) as f:
       assert f.read()=='woot3'
@@ -70,7 +70,7 @@ def test_clone_empty_repo():
     assert os.path.isdir(os.path.join(td,'.ygit'))
     assert os.path.isfile(os.path.join(td,'.ygit','config'))
     assert os.path.isfile(os.path.join(td,'.ygit','idx'))
-    assert sorted(os.listdir(os.path.join(td,'.ygit'))) == ['config', 'idx', 'refs']
+    assert sorted(os.listdir(os.path.join(td,'.ygit'))) == ['config', 'idx', 'packed-refs']
 
     
 def test_fetch_no_update():
@@ -203,3 +203,863 @@ def test_branch():
     
 
 
+
+
+class RecordingEvents(ygit.NullEvents):
+  def __init__(self):
+    self.events = []
+  def event(self, kind, value=None):
+    self.events.append((kind, value))
+
+
+def test_events():
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    events = RecordingEvents()
+    ygit.clone('http://localhost:8889/'+os.path.basename(d), td, events=events)
+    kinds = [kind for kind, value in events.events]
+    phases = [value[0] for kind, value in events.events if kind==ygit.PHASE_END]
+    assert phases == ['refs', 'download', 'index', 'checkout', 'clone']
+    assert (ygit.FILE, (td+'/test.txt', 'BLOB')) in events.events
+    assert ygit.OBJECTS in kinds and ygit.BYTES in kinds and ygit.MEM_FREE in kinds
+
+
+def test_quiet(capsys):
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    capsys.readouterr()
+    ygit.clone('http://localhost:8889/'+os.path.basename(d), td, quiet=True)
+    assert capsys.readouterr().out == ''
+    with open(os.path.join(td,'test.txt')) as f:
+      assert f.read()=='v1'
+
+
+def test_pull_async():
+  git, d = build_repo()
+  for i in range(5):
+    with open(os.path.join(d,f'test{i}.txt'),'w') as f:
+      f.write(f'v{i}')
+  git.add('.')
+  git.commit(message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.Repo(td)
+    repo._init('http://localhost:8889/'+os.path.basename(d))
+    ticks = []
+    async def ticker():
+      while True:
+        ticks.append(1)
+        await asyncio.sleep(0)
+    async def main():
+      t = asyncio.create_task(ticker())
+      await repo.pull_async(slice_ms=0)
+      t.cancel()
+    asyncio.run(main())
+    assert len(ticks) > 10
+    with open(os.path.join(td,'test4.txt')) as f:
+      assert f.read()=='v4'
+
+
+def _ref_deltas(repo):
+  with ygit.DB(f'{repo._git_dir}/idx') as db:
+    return [k for k in db.keys() if len(k)==20 and struct.unpack('QBQQQ', db[k])[1]==7]
+
+
+def _growing_file(git, d):
+  '''Returns commit(rev), committing the next revision of big.txt: the last plus some lines, so it's the best delta base.'''
+  lines = [f'line {i}\n' for i in range(2000)]
+  def commit(rev):
+    lines.extend(f'rev {rev} line {i}\n' for i in range(200))
+    with open(os.path.join(d,'big.txt'),'w') as f:
+      f.writelines(lines)
+    git.add('big.txt')
+    git.commit(message=f'rev {rev}')
+    return ''.join(lines)
+  return commit
+
+
+def test_thin_pack_pull(monkeypatch):
+  git, d = build_repo()
+  commit = _growing_file(git, d)
+  commit(0)
+  checked_out = []
+  find = ygit.Repo._checked_out
+  def spy(self, sha):
+    fn = find(self, sha)
+    checked_out.append(fn)
+    return fn
+  monkeypatch.setattr(ygit.Repo, '_checked_out', spy)
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    v1 = commit(1)
+    repo.pull()
+    assert _ref_deltas(repo) # v1 came as a delta against the blob we had
+    with open(os.path.join(td,'big.txt')) as f:
+      assert f.read()==v1
+    assert not [fn for fn in os.listdir(td) if fn.endswith('.ygit-tmp')]
+    repo.cleanup() # drops v0, the base of v1
+    with repo.open('big.txt') as f:
+      assert f.read().decode()==v1 # from the checked out file
+    v2 = commit(2)
+    repo.pull() # v2 as a delta against v1, which is only in the working tree
+    assert [fn for fn in checked_out if fn] and _ref_deltas(repo)
+    with open(os.path.join(td,'big.txt')) as f:
+      assert f.read()==v2
+    assert not repo.status(out=io.StringIO())
+    out = io.BytesIO()
+    repo.archive('HEAD', out)
+    assert v2.encode() in out.getvalue()
+
+
+def test_thin_pack_base_changed(monkeypatch):
+  git, d = build_repo()
+  commit = _growing_file(git, d)
+  commit(0)
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    commit(1)
+    repo.pull()
+    repo.cleanup()
+    with open(os.path.join(td,'big.txt'),'a') as f:
+      f.write('edited') # so v1 is nowhere
+    v2 = commit(2)
+    fetch_cmd = ygit.Repo._fetch_cmd
+    thins = []
+    def spy_cmd(self, *args, thin=False, **kwargs):
+      thins.append(thin)
+      return fetch_cmd(self, *args, thin=thin, **kwargs)
+    monkeypatch.setattr(ygit.Repo, '_fetch_cmd', spy_cmd)
+    repo.pull() # fetched again w/o a thin pack
+    assert thins==[True, False]
+    monkeypatch.undo()
+    with open(os.path.join(td,'big.txt')) as f:
+      assert f.read()==v2
+    commit(3)
+    repo.pull()
+    repo.cleanup() # so v3's base is gone, and it's only in the working tree
+    v4 = commit(4)
+    repo.fetch() # v4 as a delta against v3...
+    assert _ref_deltas(repo)
+    with open(os.path.join(td,'big.txt'),'a') as f:
+      f.write('edited') # ...until it isn't, so checkout fetches v3 whole
+    fetched = []
+    fetch_objects = ygit.Repo._fetch_objects
+    async def spy(self, db, shas, *args):
+      fetched.extend(shas)
+      await fetch_objects(self, db, shas, *args)
+    monkeypatch.setattr(ygit.Repo, '_fetch_objects', spy)
+    repo.checkout()
+    assert len(fetched)==1
+    with open(os.path.join(td,'big.txt')) as f:
+      assert f.read()==v4
+
+
+def test_autofetch_in_event_loop():
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit(message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    git.commit('--allow-empty', message='v2')
+    commit = git('rev-parse', 'HEAD').strip()
+    async def main():
+      return repo.ls(ref=commit)
+    with pytest.raises(Exception, match='fetch_async'):
+      asyncio.run(main())
+    assert repo.ls(ref=commit) == ['test.txt'] # fetches it
+
+
+def test_fetch_many(monkeypatch):
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  url = 'http://localhost:8889/'+os.path.basename(d)
+  with tempfile.TemporaryDirectory() as td:
+    repos = [ygit.clone(url, os.path.join(td, f'variant{i}')) for i in range(3)]
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write('v2')
+    git.commit('test.txt', message='v2')
+    assert ygit.fetch_many(repos[:2] + [os.path.join(td, 'variant2')], concurrency=2) == [True, True, True]
+    inodes = set()
+    for i in range(3):
+      assert sorted(s for s in os.listdir(os.path.join(td, f'variant{i}', '.ygit')) if s.endswith('.pack')) == ['1.pack', '2.pack']
+      inodes.add(os.stat(os.path.join(td, f'variant{i}', '.ygit', '2.pack')).st_ino)
+    assert len(inodes) == 1
+    for repo in repos:
+      repo.checkout()
+    with open(os.path.join(td, 'variant2', 'test.txt')) as f:
+      assert f.read()=='v2'
+    # a pack removed (as by cleanup()) mustn't get the next fetch written over a linked one
+    os.remove(os.path.join(td, 'variant0', '.ygit', '1.pack'))
+    with open(os.path.join(td, 'variant1', '.ygit', '2.pack'),'rb') as f:
+      linked = f.read()
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write('v3')
+    git.commit('test.txt', message='v3')
+    assert repos[0].fetch()
+    with open(os.path.join(td, 'variant1', '.ygit', '2.pack'),'rb') as f:
+      assert f.read()==linked
+    # clones w/ different credentials don't share responses
+    downloads = []
+    download = ygit.Repo._download_pack
+    async def counting(self, *args):
+      downloads.append(self)
+      return await download(self, *args)
+    monkeypatch.setattr(ygit.Repo, '_download_pack', counting)
+    repos[1].update_authentication('alice', 'secret')
+    repos[2].update_authentication('bob', 'secret')
+    assert ygit.fetch_many(repos[1:]) == [True, True]
+    assert len(downloads) == 2
+
+
+def test_deep_clone_with_deltas():
+  git, d = build_repo()
+  lines = [f'line {i}\n' for i in range(2000)]
+  for rev in range(10):
+    lines[rev*37] = f'changed in {rev}\n'
+    with open(os.path.join(d,'big.txt'),'w') as f:
+      f.writelines(lines)
+    git.add('big.txt')
+    git.commit('big.txt', message=f'rev {rev}')
+  git.gc() # repack, so the served pack has delta chains
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td, shallow=False)
+    with open(os.path.join(td,'big.txt')) as f:
+      assert f.read()==''.join(lines)
+    assert not repo.status(out=io.StringIO())
+    with ygit.DB(os.path.join(td,'.ygit','idx')) as db:
+      assert len(db.keys()) == len(git('rev-list', '--objects', '--all').strip().splitlines())
+
+
+def test_mapped_pack_index_matches_file(monkeypatch):
+  git, d = build_repo()
+  lines = [f'line {i}\n' for i in range(1000)]
+  for rev in range(5):
+    lines[rev*11] = f'changed in {rev}\n'
+    with open(os.path.join(d,'big.txt'),'w') as f:
+      f.writelines(lines)
+    git.add('big.txt')
+    git.commit('big.txt', message=f'rev {rev}')
+  git.gc()
+  with tempfile.TemporaryDirectory() as td:
+    ygit.clone('http://localhost:8889/'+os.path.basename(d), td, shallow=False)
+    pack = os.path.join(td,'.ygit','1.pack')
+    with ygit._platform.open_pack(pack) as f:
+      assert isinstance(f, ygit._MappedPack)
+    mapped, unmapped = {}, {}
+    asyncio.run(ygit._parse_pkt_file(td, pack, 1, mapped))
+    monkeypatch.setattr(ygit._platform, 'open_pack', lambda fn: open(fn, 'rb'))
+    asyncio.run(ygit._parse_pkt_file(td, pack, 1, unmapped))
+    assert mapped == unmapped
+
+
+class DeviceBytearray(bytearray):
+  '''A bytearray as MicroPython has it: no find(), split(), etc.'''
+  def __getattribute__(self, name):
+    if name in ('find', 'split', 'startswith', 'index', 'partition', 'decode'): raise AttributeError(name)
+    return super().__getattribute__(name)
+
+def test_parse_bytearray_objects():
+  sig = bytes(range(20))
+  tree = DeviceBytearray(b'100644 a.txt\x00' + sig + b'40000 lib\x00' + sig)
+  assert ygit._parse_tree(tree) == [(100644, 'a.txt', sig), (40000, 'lib', sig)]
+
+
+def test_mapped_inflate_is_bounded():
+  import zlib, tracemalloc
+  data = b'a small object ' * 8
+  with tempfile.TemporaryDirectory() as td:
+    fn = os.path.join(td, 'big.pack')
+    with open(fn, 'wb') as f:
+      f.write(zlib.compress(data))
+      f.write(os.urandom(1024*1024) * 32) # the rest of a big pack
+    with ygit._MappedPack(fn) as f:
+      tracemalloc.start()
+      try:
+        assert bytes(ygit._inflate(f, 0, len(data))) == data
+        peak = tracemalloc.get_traced_memory()[1]
+      finally:
+        tracemalloc.stop()
+  assert peak < 64*1024 # a window or two, not the 32MB after the object
+
+
+def test_parallel_index_matches_serial():
+  git, d = build_repo()
+  for name in 'abcdef':
+    lines = [f'{name} line {i}\n' for i in range(400)]
+    for rev in range(4):
+      lines[rev*7] = f'{name} changed in {rev}\n'
+      with open(os.path.join(d,f'{name}.txt'),'w') as f:
+        f.writelines(lines)
+      git.add(f'{name}.txt')
+      git.commit(f'{name}.txt', message=f'{name} rev {rev}')
+  git.gc()
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td, shallow=False, workers=2)
+    assert not repo.status(out=io.StringIO())
+    pack = os.path.join(td,'.ygit','1.pack')
+    idx = {}
+    for workers in (None, 2):
+      fn = os.path.join(td, f'idx-{workers}')
+      with ygit.DB(fn) as db:
+        asyncio.run(ygit._parse_pkt_file(td, pack, 1, db, workers=workers))
+      with open(fn,'rb') as f:
+        idx[workers] = f.read()
+    assert idx[None] == idx[2]
+    with open(os.path.join(td,'.ygit','idx'),'rb') as f:
+      assert f.read() == idx[None]
+
+
+def test_cone_prunes_trees(monkeypatch):
+  git, d = build_repo()
+  for path in ['other/a/x.txt', 'other/b/y.txt', 'lib/pkg/mod.py', 'lib/top.py', 'root.txt']:
+    os.makedirs(os.path.dirname(os.path.join(d,path)), exist_ok=True)
+    with open(os.path.join(d,path),'w') as f:
+      f.write(path)
+    git.add(path)
+  git.commit(message='-')
+  read = []
+  read_tree = ygit.Repo._read_tree
+  def counting_read_tree(self, db, sig):
+    entries = read_tree(self, db, sig)
+    read.append(sorted(name for mode, name, sig in entries))
+    return entries
+  monkeypatch.setattr(ygit.Repo, '_read_tree', counting_read_tree)
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td, cone='lib')
+    assert sorted(os.listdir(td)) == ['.ygit', 'pkg', 'top.py']
+    with open(os.path.join(td,'pkg','mod.py')) as f:
+      assert f.read()=='lib/pkg/mod.py'
+    assert ['a','b'] not in read and ['x.txt'] not in read
+
+
+def test_sparse():
+  git, d = build_repo()
+  for path in ['lib/a.py', 'lib/tests/test_a.py', 'lib/tests/fixture.txt', 'docs/index.md', 'main.py', 'other.py']:
+    os.makedirs(os.path.dirname(os.path.join(d,path)), exist_ok=True)
+    with open(os.path.join(d,path),'w') as f:
+      f.write(path)
+    git.add(path)
+  git.commit(message='-')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td, sparse=['lib/', '!lib/tests', 'lib/tests/fixture.txt', 'main.py'])
+    assert sorted(os.listdir(td)) == ['.ygit', 'lib', 'main.py']
+    assert sorted(os.listdir(os.path.join(td,'lib'))) == ['a.py', 'tests']
+    assert sorted(os.listdir(os.path.join(td,'lib','tests'))) == ['fixture.txt']
+    assert not repo.status(out=io.StringIO())
+    git.rm('main.py', 'other.py')
+    git.commit(message='removed')
+    with open(os.path.join(td,'other.py'),'w') as f:
+      f.write('not from the repo')
+    repo.pull()
+    assert not os.path.exists(os.path.join(td,'main.py'))
+    assert os.path.exists(os.path.join(td,'other.py'))
+
+
+def _ephemeral_round_trip():
+  git, d = build_repo()
+  lines = [f'line {i}\n' for i in range(1000)]
+  files = {'big.txt': ''.join(lines), 'lib/big2.txt': ''.join(lines[:-1]) + 'changed\n', 'lib/gone.txt': 'gone', 'other/skip.txt': 'skip'}
+  for path, content in files.items():
+    os.makedirs(os.path.dirname(os.path.join(d,path)), exist_ok=True)
+    with open(os.path.join(d,path),'w') as f:
+      f.write(content)
+    git.add(path)
+  git.commit(message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td, ephemeral=True, sparse=['big.txt', 'lib/'])
+    assert sorted(os.listdir(os.path.join(td,'.ygit'))) == ['config', 'manifest', 'packed-refs']
+    assert sorted(os.listdir(td)) == ['.ygit', 'big.txt', 'lib']
+    for path in ['big.txt', 'lib/big2.txt', 'lib/gone.txt']:
+      with open(os.path.join(td,path)) as f:
+        assert f.read()==files[path]
+    assert not repo.status(out=io.StringIO())
+    with open(os.path.join(td,'big.txt'),'a') as f:
+      f.write('local change')
+    out = io.StringIO()
+    assert repo.status(out=out)
+    assert out.getvalue()=='M /big.txt\n'
+    git.rm('lib/gone.txt')
+    os.makedirs(os.path.join(d,'lib','sub'))
+    with open(os.path.join(d,'lib','sub','new.txt'),'w') as f:
+      f.write('new')
+    git.add('lib/sub/new.txt')
+    git.commit(message='v2')
+    repo.pull()
+    assert not os.path.exists(os.path.join(td,'lib','gone.txt'))
+    with open(os.path.join(td,'lib','sub','new.txt')) as f:
+      assert f.read()=='new'
+    with open(os.path.join(td,'big.txt')) as f:
+      assert f.read()==files['big.txt']
+    assert not repo.status(out=io.StringIO())
+    assert sorted(os.listdir(os.path.join(td,'.ygit'))) == ['config', 'manifest', 'packed-refs']
+
+
+def test_ephemeral_clone():
+  _ephemeral_round_trip()
+
+
+class DevicePlatform(ygit._MicroPython):
+  '''MicroPython's inflate and pack handling, w/ zlib standing in for the deflate module.'''
+  def inflater(self, f, pos):
+    return ygit._ZlibReader(f, pos) # leaves f just past the stream, as DeflateIO does
+
+
+def test_ephemeral_clone_spooled(monkeypatch):
+  monkeypatch.setattr(ygit, '_platform', DevicePlatform())
+  _ephemeral_round_trip()
+
+
+@pytest.mark.parametrize('device', [False, True])
+def test_ephemeral_cone_keeps_little(monkeypatch, device):
+  if device: monkeypatch.setattr(ygit, '_platform', DevicePlatform())
+  git, d = build_repo()
+  lines = [f'line {i}\n' for i in range(2000)]
+  files = {f'outside/{i}.bin': os.urandom(32*1024) for i in range(10)}
+  files['outside/big.txt'] = ''.join(lines).encode() # the delta base for...
+  files['inside/big.txt'] = ''.join(lines[:-1]).encode() + b'changed\n'
+  files['inside/small.txt'] = b'small'
+  for path, content in files.items():
+    os.makedirs(os.path.dirname(os.path.join(d,path)), exist_ok=True)
+    with open(os.path.join(d,path),'wb') as f:
+      f.write(content)
+    git.add(path)
+  git.commit(message='v1')
+  peak = [0]
+  end = ygit._StreamCheckout.end
+  def measure(self):
+    end(self)
+    peak[0] = max(peak[0], sum(os.path.getsize(os.path.join(self._tmp, fn)) for fn in os.listdir(self._tmp)))
+  monkeypatch.setattr(ygit._StreamCheckout, 'end', measure)
+  spool_peak = [0]
+  spool_write = ygit._SpooledPackStream.write
+  def measure_spool(self, data):
+    spool_write(self, data)
+    spool_peak[0] = max(spool_peak[0], sum(os.path.getsize(fn) for fn in self._fns if os.path.exists(fn)))
+  monkeypatch.setattr(ygit._SpooledPackStream, 'write', measure_spool)
+  written = ygit._written.bytes
+  with tempfile.TemporaryDirectory() as td:
+    ygit.clone('http://localhost:8889/'+os.path.basename(d), td, ephemeral=True, cone='inside')
+    assert ygit._written.bytes - written < 1.1*sum(len(content) for content in files.values()) # retries aren't rewritten
+    assert sorted(os.listdir(td)) == ['.ygit', 'big.txt', 'small.txt']
+    for path in ['big.txt', 'small.txt']:
+      with open(os.path.join(td,path),'rb') as f:
+        assert f.read()==files['inside/'+path]
+  assert peak[0] < 32*1024 # not the 300KB+ outside the cone
+  if device: assert spool_peak[0] < 96*1024 # about two objects, not the whole pack
+
+
+class CountingStream:
+  def __init__(self, data):
+    self.data = data
+    self.reads = 0
+  async def read(self, n):
+    self.reads += 1
+    ret, self.data = self.data[:n], self.data[n:]
+    return ret
+
+
+def test_buffered_stream():
+  lines = [b'0032want %s\n' % (b'%040d' % i) for i in range(100)]
+  x = CountingStream(b'HTTP/1.0 200 OK\r\nContent-Type: x\r\n\r\n' + b''.join(lines) + b'0000')
+  async def read_all():
+    s = ygit._BufferedStream(x, bufsize=1024)
+    await ygit._read_headers(s)
+    return [line async for line in ygit._PktLines(s, bufsize=128)]
+  assert asyncio.run(read_all()) == [line[4:] for line in lines]
+  assert x.reads < 10
+
+
+def test_buffered_stream_timeout():
+  async def read():
+    s = ygit._BufferedStream(asyncio.StreamReader(), timeout_ms=50)
+    await s.readline()
+  try:
+    asyncio.run(read())
+    assert False, 'expected a timeout'
+  except asyncio.TimeoutError:
+    pass
+
+
+def test_refs_only_written_when_changed():
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  git.tag('v1')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    fn = os.path.join(td,'.ygit','packed-refs')
+    with open(fn) as f:
+      packed = f.read()
+    assert 'refs/tags/v1\n' in packed
+    os.utime(fn, (0, 0))
+    repo.fetch()
+    assert os.stat(fn).st_mtime == 0
+    git.tag('v2')
+    git.tag('-d', 'v1')
+    repo.fetch()
+    assert os.stat(fn).st_mtime != 0
+    assert repo.tags() == ['v2']
+    assert repo._ref_to_commit('v2') == git('rev-parse', 'HEAD').strip().encode()
+
+
+def test_check_for_updates(monkeypatch):
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    assert not repo.check_for_updates()
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write('v2')
+    git.commit('test.txt', message='v2')
+    assert repo.check_for_updates()
+    assert repo.check_for_updates(git.branch(show_current=True).strip())
+    repo.watch(polls=1)
+    with open(os.path.join(td,'test.txt')) as f:
+      assert f.read()=='v2'
+    assert not repo.check_for_updates()
+    # a proxy answering 304 to the cached ETag ends the check before any pkt-lines are read
+    sent = {}
+    class Closed:
+      def close(self): pass
+      async def wait_closed(self): pass
+    async def not_modified(url, data=None, extra_headers=None):
+      sent.update(extra_headers or {})
+      return ygit._BufferedStream(CountingStream(b'HTTP/1.1 304 Not Modified\r\n\r\n')), Closed()
+    repo._etags[b'HEAD'] = ('"abc"', git('rev-parse', 'HEAD').strip().encode())
+    monkeypatch.setattr(repo, '_git_upload_pack', not_modified)
+    assert not repo.check_for_updates()
+    assert sent == {'If-None-Match': '"abc"'}
+
+
+def test_fetch_several_refs():
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  git.tag('v1')
+  main_branch = git.branch(show_current=True).strip()
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write('v2')
+    git.commit('test.txt', message='v2')
+    git.checkout('-b', 'release')
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write('release')
+    git.commit('test.txt', message='release')
+    git.checkout(main_branch)
+    packs = len([fn for fn in os.listdir(os.path.join(td,'.ygit')) if fn.endswith('.pack')])
+    assert repo.fetch(refs=[main_branch, 'release', 'v1'])
+    assert len([fn for fn in os.listdir(os.path.join(td,'.ygit')) if fn.endswith('.pack')]) == packs+1
+    assert not repo.fetch(refs=[main_branch, 'release'])
+    repo.checkout('release')
+    with open(os.path.join(td,'test.txt')) as f:
+      assert f.read()=='release'
+    repo.checkout(main_branch)
+    with open(os.path.join(td,'test.txt')) as f:
+      assert f.read()=='v2'
+    assert len([fn for fn in os.listdir(os.path.join(td,'.ygit')) if fn.endswith('.pack')]) == packs+1
+
+
+def test_shallow_boundary():
+  git, d = build_repo()
+  commits = []
+  for rev in range(3):
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write(f'v{rev}')
+    git.add('test.txt')
+    git.commit('test.txt', message=f'v{rev}')
+    commits.append(git('rev-parse', 'HEAD').strip().encode())
+  def indexed(td, commit):
+    with ygit.DB(os.path.join(td,'.ygit','idx')) as db:
+      return binascii.unhexlify(commit) in db
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    assert repo._shallow() == [commits[2]]
+    assert not indexed(td, commits[1])
+    assert repo.fetch(deepen=1)
+    assert indexed(td, commits[1]) and not indexed(td, commits[0])
+    assert repo._shallow() == [commits[1]]
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write('v3')
+    git.commit('test.txt', message='v3')
+    repo.pull()
+    with open(os.path.join(td,'test.txt')) as f:
+      assert f.read()=='v3'
+    assert commits[1] in repo._shallow()
+
+
+def test_open_and_ls():
+  git, d = build_repo()
+  lines = [f'line {i}\n' for i in range(500)]
+  os.makedirs(os.path.join(d,'lib','sub'))
+  for rev in range(2):
+    lines[rev] = f'rev {rev}\n'
+    with open(os.path.join(d,'lib','config.txt'),'w') as f:
+      f.writelines(lines)
+    with open(os.path.join(d,'lib','sub','x.txt'),'w') as f:
+      f.write(f'x{rev}')
+    git.add('lib/config.txt', 'lib/sub/x.txt')
+    git.commit(message=f'rev {rev}')
+  git.gc()
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td, shallow=False)
+    assert repo.ls() == ['lib/']
+    assert repo.ls('lib') == ['config.txt', 'sub/']
+    with repo.open('lib/config.txt') as f:
+      assert f.read()==''.join(lines).encode()
+    with repo.open('lib/sub/x.txt') as f:
+      assert f.read(1)==b'x' and f.read()==b'1'
+    parent = git('rev-parse', 'HEAD~1').strip()
+    with repo.open('/lib/config.txt', ref=parent) as f:
+      assert f.read().startswith(b'rev 0\nline 1\n')
+    for bad in ['lib', 'nope.txt', 'lib/config.txt/x']:
+      try:
+        repo.open(bad)
+        assert False, bad
+      except Exception as e:
+        assert 'not a' in str(e) or 'no such file' in str(e)
+
+
+def test_manifest():
+  git, d = build_repo()
+  os.makedirs(os.path.join(d,'lib','sub'))
+  for fn in ['lib/a.txt', 'lib/ab.txt', 'lib/sub/b.txt', 'top.txt']:
+    with open(os.path.join(d,fn),'w') as f:
+      f.write(fn)
+  git.add('lib', 'top.txt')
+  git.commit(message='files')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td)
+    manifest = repo._manifest()
+    assert manifest.commit == git('rev-parse', 'HEAD').strip().encode()
+    assert [entry[0] for entry in manifest] == ['lib/a.txt', 'lib/ab.txt', 'lib/sub/b.txt', 'top.txt']
+    assert all(entry[1]==100644 for entry in manifest)
+    # unchanged files aren't rewritten, removed ones are deleted
+    git.rm('lib/ab.txt')
+    with open(os.path.join(d,'top.txt'),'w') as f:
+      f.write('top v2')
+    git.commit('-a', message='changes')
+    mtime = os.stat(os.path.join(td,'lib','sub','b.txt')).st_mtime_ns
+    repo.pull()
+    assert not os.path.exists(os.path.join(td,'lib','ab.txt'))
+    with open(os.path.join(td,'top.txt')) as f:
+      assert f.read()=='top v2'
+    assert os.stat(os.path.join(td,'lib','sub','b.txt')).st_mtime_ns == mtime
+    assert [entry[0] for entry in repo._manifest()] == ['lib/a.txt', 'lib/sub/b.txt', 'top.txt']
+    # status trusts the stat cache, but a same size edit is still caught
+    out = io.StringIO()
+    assert not repo.status(out=out) and out.getvalue()==''
+    with open(os.path.join(td,'lib','a.txt'),'w') as f:
+      f.write('lib/A.txt')
+    out = io.StringIO()
+    assert repo.status(out=out) and out.getvalue()=='M /lib/a.txt\n'
+
+
+def test_memory_governor(monkeypatch):
+  git, d = build_repo()
+  lines = [f'line {i}\n' for i in range(300)]
+  for rev in range(4):
+    lines[rev] = f'rev {rev}\n'
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.writelines(lines)
+    git.add('test.txt')
+    git.commit(message=f'rev {rev}')
+  monkeypatch.setattr(ygit._platform, 'open_pack', lambda fn: open(fn, 'rb')) # inflate w/ DecompIO
+  class FakeGC:
+    free = 1 << 20
+    collections = 0
+    def mem_free(self): return self.free
+    def collect(self): FakeGC.collections += 1
+  monkeypatch.setattr(ygit, 'gc', FakeGC())
+  with tempfile.TemporaryDirectory() as td:
+    ygit.clone('http://localhost:8889/'+os.path.basename(d), td, shallow=False)
+    plenty = FakeGC.collections
+  assert plenty <= 2 # only once an operation is done
+  FakeGC.free = 16*1024
+  with tempfile.TemporaryDirectory() as td:
+    ygit.clone('http://localhost:8889/'+os.path.basename(d), td, shallow=False)
+  assert FakeGC.collections - plenty > 10 # before every inflate window
+
+
+def test_import_is_lazy():
+  # import w/o any stand-ins for MicroPython modules on the path, and w/o loading platform services
+  script = "import sys, ygit; print(' '.join(m for m in ('cryptolib', 'machine', 'deflate', 'uuid', 'asyncio', 'ssl', 'socket', 'zlib', 'mmap') if m in sys.modules))"
+  env = {k:v for k,v in os.environ.items() if k!='PYTHONPATH'}
+  p = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], capture_output=True, text=True, env=env,
+                     cwd=os.path.dirname(os.path.abspath(ygit.__file__)))
+  assert p.returncode==0, p.stderr
+  assert p.stdout.strip()==''
+  us = [int(line.split('|')[1]) for line in p.stderr.splitlines() if line.split('|')[-1].strip()=='ygit']
+  print('import ygit:', us[0], 'us (cumulative)')
+
+
+def test_cipher_round_trip():
+  c = ygit._platform.cipher()
+  secret = b'Basic dXNlcjpwYXNz'.ljust(32)
+  assert c.encrypt(secret)!=secret and c.decrypt(c.encrypt(secret))==secret
+
+
+def test_slots():
+  git, d = build_repo()
+  for fn in ['keep.txt', 'change.txt']:
+    with open(os.path.join(d,fn),'w') as f:
+      f.write(f'{fn} v1')
+  git.add('keep.txt', 'change.txt')
+  git.commit(message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), td, slots=True)
+    assert sorted(os.listdir(td)) == ['.ygit', 'a']
+    assert repo.work_dir() == f'{td}/a'
+    with open(os.path.join(td,'a','change.txt')) as f:
+      assert f.read()=='change.txt v1'
+    with open(os.path.join(d,'change.txt'),'w') as f:
+      f.write('change.txt v2')
+    git.commit('-a', message='v2')
+    repo.pull()
+    assert repo.work_dir() == f'{td}/b'
+    with open(os.path.join(td,'b','change.txt')) as f:
+      assert f.read()=='change.txt v2'
+    with open(os.path.join(td,'a','change.txt')) as f:
+      assert f.read()=='change.txt v1'
+    assert os.stat(os.path.join(td,'a','keep.txt')).st_ino == os.stat(os.path.join(td,'b','keep.txt')).st_ino
+    assert not repo.status(out=io.StringIO())
+    repo.rollback()
+    assert repo.work_dir() == f'{td}/a'
+    with open(os.path.join(td,'a','change.txt')) as f:
+      assert f.read()=='change.txt v1'
+    repo.checkout() # back to HEAD, rebuilding slot b
+    assert repo.work_dir() == f'{td}/b'
+    with open(os.path.join(td,'b','change.txt')) as f:
+      assert f.read()=='change.txt v2'
+
+
+def test_flash_writes():
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('x'*3000)
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  with tempfile.TemporaryDirectory() as td:
+    events = RecordingEvents()
+    ygit.clone('http://localhost:8889/'+os.path.basename(d), td, events=events, block_size=512)
+    written, last = {}, None
+    for kind, value in events.events:
+      if kind==ygit.WRITTEN: last = value
+      if kind==ygit.PHASE_END: written[value[0]] = last
+    blocks = lambda n: (n+511)//512
+    pack = os.path.getsize(os.path.join(td,'.ygit','1.pack'))
+    assert written['download'] == (pack, blocks(pack))
+    manifest = os.path.getsize(os.path.join(td,'.ygit','manifest'))
+    assert written['checkout'] == (3000+manifest, blocks(3000)+blocks(manifest))
+    assert written['clone'][0] == pack+3000+manifest
+
+
+def test_archive():
+  import tarfile
+  git, d = build_repo()
+  os.makedirs(os.path.join(d,'lib','sub'))
+  target = 'lib/' + '../lib/'*20 + 'big.txt' # too long for a ustar header
+  os.symlink(target, os.path.join(d,'link'))
+  lines = [f'line {i}\n' for i in range(500)]
+  for rev in range(3):
+    lines[rev] = f'rev {rev}\n'
+    with open(os.path.join(d,'lib','big.txt'),'w') as f:
+      f.writelines(lines)
+    with open(os.path.join(d,'lib','sub','run.sh'),'w') as f:
+      f.write(f'echo {rev}\n')
+    os.chmod(os.path.join(d,'lib','sub','run.sh'), 0o755)
+    with open(os.path.join(d,'top.txt'),'w') as f:
+      f.write('top')
+    git.add('lib', 'top.txt', 'link')
+    git.commit(message=f'rev {rev}')
+  git.gc()
+  with tempfile.TemporaryDirectory() as td:
+    repo = ygit.clone('http://localhost:8889/'+os.path.basename(d), os.path.join(td,'clone'), shallow=False)
+    out = io.BytesIO()
+    repo.archive('HEAD', out)
+    assert len(out.getvalue()) % 10240 == 0
+    with tarfile.open(fileobj=io.BytesIO(out.getvalue())) as tar:
+      assert sorted(tar.getnames()) == ['lib', 'lib/big.txt', 'lib/sub', 'lib/sub/run.sh', 'link', 'top.txt']
+      assert tar.getmember('link').issym() and tar.getmember('link').linkname == target
+      assert tar.extractfile('lib/big.txt').read() == ''.join(lines).encode()
+      assert tar.getmember('lib/sub/run.sh').mode == 0o755 and tar.getmember('top.txt').mode == 0o644
+      assert tar.getmember('top.txt').mtime == int(git('--no-pager', 'log', '-1', '--format=%ct').strip())
+    out = io.BytesIO()
+    repo.archive(git('rev-parse', 'HEAD~2').strip(), out, cone='lib', format='tar.gz')
+    with tarfile.open(fileobj=io.BytesIO(out.getvalue()), mode='r:gz') as tar:
+      assert sorted(tar.getnames()) == ['big.txt', 'sub', 'sub/run.sh']
+      assert tar.extractfile('sub/run.sh').read() == b'echo 0\n'
+
+
+def test_stats_count_consumed():
+  data = [os.urandom(n) for n in (100, 30000, 5)]
+  with tempfile.TemporaryDirectory() as td:
+    fn = f'{td}/objs'
+    with open(fn, 'wb') as f:
+      for d in data:
+        f.write(zlib.compress(d))
+    stats = ygit._Stats()
+    stats.install()
+    try:
+      with ygit._MappedPack(fn) as f:
+        pos = 0
+        for d in data:
+          assert f.inflate(pos, len(d)) == d
+          pos += len(zlib.compress(d))
+    finally:
+      stats.uninstall()
+    assert stats.read == os.path.getsize(fn) # what was inflated, not the 16K windows handed to zlib
+    assert stats.inflated == 3
+
+
+def test_cli():
+  git, d = build_repo()
+  with open(os.path.join(d,'test.txt'),'w') as f:
+    f.write('v1')
+  git.add('test.txt')
+  git.commit('test.txt', message='v1')
+  ygit_py = os.path.abspath(ygit.__file__)
+  def run(*args):
+    p = subprocess.run([sys.executable, ygit_py, *args], capture_output=True, text=True)
+    assert p.returncode==0, p.stderr
+    return p.stdout
+  with tempfile.TemporaryDirectory() as td:
+    out = run('--stats', '--trace-memory', 'clone', d, f'{td}/clone') # a local path, served w/ git http-backend
+    header = [line.split() for line in out.splitlines() if line.startswith('phase')][0]
+    assert header == ['phase', 'ms', 'peak', 'inflated', 'read', 'seeks', 'received', 'written', 'blocks']
+    assert [line.split()[0] for line in out.splitlines()[-6:]] == ['total', 'clone', 'refs', 'download', 'index', 'checkout']
+    with open(f'{td}/clone/test.txt') as f:
+      assert f.read()=='v1'
+    with open(os.path.join(d,'test.txt'),'w') as f:
+      f.write('v2')
+    git.commit('-a', message='v2')
+    run('-q', 'fetch', f'{td}/clone')
+    out = run('-q', '--profile', 'checkout', f'{td}/clone')
+    assert 'Ordered by: cumulative time' in out
+    with open(f'{td}/clone/test.txt') as f:
+      assert f.read()=='v2'
+    repo = ygit.Repo(f'{td}/clone')
+    with ygit.DB(f'{repo._git_dir}/config') as config:
+      assert config[b'repo'] == d.encode() # not the URL it was served at
+    methods = (ygit._MappedPack.read, ygit._MappedPack.inflate, ygit._ZlibReader.read)
+    ygit._main(['-q', '--stats', 'log', f'{td}/clone'])
+    assert (ygit._MappedPack.read, ygit._MappedPack.inflate, ygit._ZlibReader.read) == methods
@@ -0,0 +1,216 @@
+import os, ast, json, shutil, tempfile, threading, subprocess, tracemalloc, pytest
+
+import ygit
+
+from test_localhost import build_repo
+
+# Heap-ceiling regression harness.
+#
+# Replays clone / pull / checkout against a local repo (see test_localhost.py for the nginx
+# prereq) under tracemalloc, and fails if any phase's peak exceeds the budget recorded in
+# misc/memory_budgets.json.  To accept a new baseline after an intentional change, run:
+#
+#   YGIT_RECORD_BUDGETS=1 pytest -s test_memory.py
+#
+# If a MicroPython unix port is available (on $PATH as `micropython`, or via $YGIT_MICROPYTHON)
+# the same phases are also replayed under a hard `-X heapsize` cap.
+
+
+BUDGETS_FN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'misc', 'memory_budgets.json')
+HEADROOM = 1.10 # budgets are recorded with 10% slack
+SIMULATED_MEM_FREE = 100*1024 # what gc.mem_free() reports, so buffers are sized as they would be on a device
+WATCHED = ('DecompIO', '_ObjReader', '_PktLines')
+URL = 'http://localhost:8889/'
+
+
+def _ygit_functions():
+  '''Maps ygit.py line numbers to the (class qualified) name of the function containing them.'''
+  with open(ygit.__file__) as f:
+    tree = ast.parse(f.read())
+  lines = {}
+  def visit(node, prefix):
+    for child in ast.iter_child_nodes(node):
+      if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        name = prefix + child.name
+        if not isinstance(child, ast.ClassDef):
+          for i in range(child.lineno, child.end_lineno+1):
+            lines[i] = name
+        visit(child, name+'.')
+  visit(tree, '')
+  return lines
+
+
+class _Phase:
+  '''Measures one phase: peak traced bytes, largest single live allocation, and who held memory at the peak.'''
+
+  _functions = None
+  _filename = None
+
+  def __init__(self, name, interval=0.005):
+    self.name = name
+    self.interval = interval
+    self.peak = 0
+    self.largest = 0
+    self.by_function = {}
+    self._high = 0
+    self._stop = threading.Event()
+
+  def __enter__(self):
+    if _Phase._functions is None:
+      _Phase._functions = _ygit_functions()
+      _Phase._filename = os.path.abspath(ygit.__file__)
+    tracemalloc.start(25)
+    tracemalloc.clear_traces()
+    self._thread = threading.Thread(target=self._sample, daemon=True)
+    self._thread.start()
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self._stop.set()
+    self._thread.join()
+    self._snapshot()
+    self.peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+  def _sample(self):
+    while not self._stop.wait(self.interval):
+      current = tracemalloc.get_traced_memory()[0]
+      if current > self._high:
+        self._snapshot()
+
+  def _snapshot(self):
+    snapshot = tracemalloc.take_snapshot()
+    total = 0
+    by_function = {}
+    for trace in snapshot.traces:
+      total += trace.size
+      self.largest = max(self.largest, trace.size)
+      for frame in reversed(trace.traceback): # innermost ygit frame
+        if frame.filename==self._filename:
+          name = self._functions.get(frame.lineno, '<module>')
+          by_function[name] = by_function.get(name, 0) + trace.size
+          break
+    if total >= self._high:
+      self._high = total
+      self.by_function = by_function
+
+  def watched(self):
+    ret = {}
+    for name, size in self.by_function.items():
+      for w in WATCHED:
+        if name==w or name.startswith(w+'.'):
+          ret[w] = ret.get(w, 0) + size
+    return ret
+
+  def report(self):
+    # only the peak is budgeted; the largest allocation is sampled, so it's reported but too noisy to assert on
+    print(f'{self.name}: peak={self.peak} largest_alloc={self.largest} at_peak={self.watched()}')
+    return {'peak': self.peak}
+
+
+def _load_budgets():
+  try:
+    with open(BUDGETS_FN) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+
+
+def _check(results):
+  budgets = _load_budgets()
+  if os.environ.get('YGIT_RECORD_BUDGETS'):
+    for phase, measured in results.items():
+      budgets[phase] = {k:int(v*HEADROOM) for k,v in measured.items()}
+    with open(BUDGETS_FN,'w') as f:
+      json.dump(budgets, f, indent=2, sort_keys=True)
+      f.write('\n')
+    return
+  over = []
+  for phase, measured in results.items():
+    if phase not in budgets:
+      over.append(f'{phase}: no recorded budget (run with YGIT_RECORD_BUDGETS=1)')
+      continue
+    for k,v in measured.items():
+      if v > budgets[phase][k]:
+        over.append(f'{phase}: {k} {v} > budget {budgets[phase][k]}')
+  assert not over, '\n'.join(over)
+
+
+def _build_fixture():
+  git, d = build_repo()
+  # a mid-sized file w/ a few revisions, so the pack contains deltas
+  lines = [f'line {i}: {"x"*(i%60)}\n' for i in range(2000)]
+  for rev in range(3):
+    lines[rev*100] = f'revision {rev}\n'
+    with open(os.path.join(d,'big.txt'),'w') as f:
+      f.writelines(lines)
+    os.makedirs(os.path.join(d,'subdir'), exist_ok=True)
+    with open(os.path.join(d,'subdir','small.txt'),'w') as f:
+      f.write(f'v{rev}')
+    git.add('big.txt', 'subdir/small.txt')
+    git.commit('big.txt', 'subdir/small.txt', message=f'rev {rev}')
+  main_branch = git.branch(show_current=True).strip()
+  git.checkout('-b', 'abranch')
+  with open(os.path.join(d,'branch.txt'),'w') as f:
+    f.write('abranch')
+  git.add('branch.txt')
+  git.commit('branch.txt', message='a branch')
+  git.checkout(main_branch)
+  return git, d
+
+
+def _commit_change(git, d):
+  with open(os.path.join(d,'big.txt'),'a') as f:
+    f.write('appended\n')
+  git.commit('big.txt', message='append')
+
+
+@pytest.fixture
+def device_heap(monkeypatch):
+  monkeypatch.setattr(ygit.gc, 'mem_free', lambda: SIMULATED_MEM_FREE, raising=False)
+
+
+def test_heap_budgets(device_heap):
+  git, d = _build_fixture()
+  results = {}
+  with tempfile.TemporaryDirectory() as td: # untraced, so one-time costs (imports, asyncio's resolver thread) aren't budgeted
+    ygit.clone(URL+os.path.basename(d), td, shallow=False)
+  with tempfile.TemporaryDirectory() as td:
+    with _Phase('clone') as p:
+      repo = ygit.clone(URL+os.path.basename(d), td, shallow=False)
+    results['clone'] = p.report()
+    _commit_change(git, d)
+    with _Phase('pull') as p:
+      repo.pull()
+    results['pull'] = p.report()
+    with _Phase('checkout') as p:
+      repo.checkout(ref='abranch')
+    results['checkout'] = p.report()
+  _check(results)
+
+
+MICROPYTHON_SCRIPT = '''
+import sys, gc
+sys.path.insert(0, %r)
+import ygit
+repo = ygit.clone(%r, %r, shallow=False)
+gc.collect(); print('YGIT_PHASE clone', gc.mem_free())
+repo.checkout(ref='abranch')
+gc.collect(); print('YGIT_PHASE checkout', gc.mem_free())
+'''
+
+def _micropython():
+  return os.environ.get('YGIT_MICROPYTHON') or shutil.which('micropython')
+
+
+@pytest.mark.skipif(not _micropython(), reason='MicroPython unix port not found')
+def test_micropython_heap_cap():
+  git, d = _build_fixture()
+  heapsize = _load_budgets().get('micropython_heapsize', '100k')
+  with tempfile.TemporaryDirectory() as td:
+    target = os.path.join(td, 'clone')
+    script = MICROPYTHON_SCRIPT % (os.path.dirname(os.path.abspath(ygit.__file__)), URL+os.path.basename(d), target)
+    p = subprocess.run([_micropython(), '-X', f'heapsize={heapsize}', '-c', script], capture_output=True, text=True)
+    print(p.stdout)
+    assert p.returncode==0 and 'MemoryError' not in p.stderr, p.stderr
+    assert [line.split()[1] for line in p.stdout.splitlines() if line.startswith('YGIT_PHASE')] == ['clone', 'checkout']
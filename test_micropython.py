@@ -205,6 +205,17 @@ def test_cone_on_device():
 
 
 
+def test_import_time():
+  pyb = init_board(clear=False)
+  pyb.enter_raw_repl()
+  out = pyb.exec_("import time, sys\nt = time.ticks_us()\nimport ygit\nprint(time.ticks_diff(time.ticks_us(), t), 'cryptolib' in sys.modules)")
+  pyb.exit_raw_repl()
+  us, loaded = out.decode().split()
+  print('import ygit:', us, 'us')
+  assert loaded=='False'
+
+
+
 def get_ip():
   import socket
   with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
@@ -1,4 +1,4 @@
-import gc, socket, ssl, struct, os, io, binascii, hashlib, json, collections, time, sys, cryptolib, machine, deflate
+import gc, struct, os, io, binascii, hashlib, json, collections, time, sys, random
 
 __version__ = '0.5.0'
 __description__ = 'A tiny (yocto) git client for MicroPython.'
@@ -13,13 +13,191 @@ if not hasattr(gc, 'mem_free'):
       pass
   gc = FakeGC()
 
+
+class _LazyAsyncio:
+  '''
+    Stands in for the asyncio module until something of it is used, since importing it loads ssl, socket,
+    selectors and concurrent.futures, most of what ``import ygit`` would otherwise cost on CPython.
+  '''
+  def __getattr__(self, name):
+    global asyncio
+    try:
+      import asyncio as module
+    except ImportError:
+      import uasyncio as module
+    asyncio = module
+    return getattr(module, name)
+
+asyncio = _LazyAsyncio()
+
+
+def _ticks_ms():
+  return time.ticks_ms() if hasattr(time, 'ticks_ms') else int(time.monotonic()*1000)
+
+
+def _ticks_diff(a, b):
+  return time.ticks_diff(a, b) if hasattr(time, 'ticks_diff') else a-b
+
+
+# event kinds (and the type of their value)
+PHASE_START = 'phase_start' # str: phase name
+PHASE_END = 'phase_end'     # (str, int): phase name, elapsed ms
+OBJECTS = 'objects'         # int: objects indexed so far in this phase
+BYTES = 'bytes'             # int: bytes received so far in this phase
+FILE = 'file'               # (str, str): filename, object kind
+MEM_FREE = 'mem_free'       # int: gc.mem_free()
+WRITTEN = 'written'         # (int, int): bytes and filesystem blocks written during the phase that just ended
+MESSAGE = 'message'         # str: server progress / informational text
+
+
+class NullEvents:
+  '''
+    An event sink that discards everything.  To receive events, subclass it and override ``event()``, then
+    pass an instance as ``events`` to ``clone()`` or ``Repo()``.
+  '''
+
+  def event(self, kind, value=None):
+    '''Called once per event.  See the module level ``PHASE_START``, ``OBJECTS``, etc. for the kinds.'''
+    pass
+
+  def span(self, phase):
+    '''Context manager that emits ``PHASE_START`` / ``PHASE_END`` (w/ timing) and ``MEM_FREE`` samples.'''
+    return _Span(self, phase)
+
+
+class _Span:
+
+  def __init__(self, events, phase):
+    self._events = events
+    self._phase = phase
+
+  def __enter__(self):
+    self._start = _ticks_ms()
+    self._written = (_written.bytes, _written.blocks)
+    self._events.event(PHASE_START, self._phase)
+    self._events.event(MEM_FREE, gc.mem_free())
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self._events.event(MEM_FREE, gc.mem_free())
+    self._events.event(WRITTEN, (_written.bytes-self._written[0], _written.blocks-self._written[1]))
+    self._events.event(PHASE_END, (self._phase, _ticks_diff(_ticks_ms(), self._start)))
+
+
+class ConsoleEvents(NullEvents):
+  '''
+    The default event sink.  Prints messages as they arrive, but progress (objects, bytes, files written)
+    at most once every ``interval_ms``, as console I/O over a serial REPL is slow.
+
+    :param out: A file-like object.  Defaults to ``sys.stdout``.
+    :param interval_ms: Minimum time between progress lines.
+    :param verbose: Print every file written, phase timings and memory samples.
+  '''
+
+  def __init__(self, out=None, interval_ms=1000, verbose=False):
+    self._out = out
+    self._interval_ms = interval_ms
+    self._verbose = verbose
+    self._phases = []
+    self._progress = None
+    self._files = 0
+    self._last = None
+
+  def _write(self, s):
+    out = self._out or sys.stdout
+    out.write(s)
+    out.write('\n')
+
+  def _due(self):
+    now = _ticks_ms()
+    if self._last is None or _ticks_diff(now, self._last) >= self._interval_ms:
+      self._last = now
+      return True
+    return False
+
+  def event(self, kind, value=None):
+    phase = self._phases[-1] if self._phases else ''
+    if kind==MESSAGE:
+      self._write(value)
+    elif kind==PHASE_START:
+      self._phases.append(value)
+      self._progress = None
+      self._files = 0
+      self._last = None
+    elif kind==PHASE_END:
+      phase, ms = value
+      if self._phases: self._phases.pop()
+      if self._progress:
+        self._write(f'{phase}: {self._progress}, done in {ms}ms')
+      elif self._verbose:
+        self._write(f'{phase}: done in {ms}ms')
+      self._progress = None
+    elif kind==OBJECTS or kind==BYTES:
+      self._progress = f'{value} {kind}'
+      if self._due():
+        self._write(f'{phase}: {self._progress}')
+    elif kind==FILE:
+      fn, obj_kind = value
+      self._files += 1
+      self._progress = f'{self._files} files written'
+      if self._verbose or self._due():
+        self._write(f'writing: {fn} ({obj_kind})')
+    elif kind==MEM_FREE and self._verbose:
+      self._write(f'{phase} mem_free: {value}')
+    elif kind==WRITTEN and self._verbose and value[0]:
+      self._write(f'{phase} written: {value[0]} bytes in {value[1]} blocks')
+
+
+_NULL_EVENTS = NullEvents()
+
+
+class _Slicer:
+  '''Yields to the asyncio event loop once more than ``slice_ms`` has passed since the last yield.'''
+
+  def __init__(self, slice_ms=50):
+    self._slice_ms = slice_ms
+    self._last = _ticks_ms()
+
+  async def tick(self):
+    if _ticks_diff(_ticks_ms(), self._last) >= self._slice_ms:
+      await asyncio.sleep(0)
+      self._last = _ticks_ms()
+
+
+_WINDOW = 32*1024 # what inflating a zlib stream allocates
+
+
+class _MemoryGovernor:
+  '''
+    Decides when a ``gc.collect()`` is worth its cost.  A collection is a full mark and sweep, too slow to run
+    for every object, so it's only done when ``gc.mem_free()`` says the next allocation might not fit.
+  '''
+
+  def __init__(self, slack=8*1024):
+    self.slack = slack
+    self.collections = 0
+
+  def reserve(self, nbytes):
+    '''Makes room for an allocation of about nbytes, collecting only if free memory is short.'''
+    free = gc.mem_free()
+    if free and free < nbytes + self.slack:
+      self.collect()
+
+  def collect(self):
+    gc.collect()
+    self.collections += 1
+
+
+_memory = _MemoryGovernor()
+
+
 class DecompIO:
     '''Wrapper for deflate.DeflateIO, for memory management and support for seeking in large compressed files.'''
 
     @classmethod
     def kill(cls):
-        '''Class method to force garbage collection.'''
-        gc.collect()
+        '''Class method to force garbage collection, once an operation is done.'''
+        _memory.collect()
 
     def __init__(self, f):
         '''Initialize the decompression wrapper with the input stream.'''
@@ -31,9 +209,10 @@ class DecompIO:
         self._reset_decompressor()
 
     def _reset_decompressor(self):
-        '''Reset the decompressor to free up memory and minimize fragmentation.'''
-        gc.collect()  # Force garbage collection to free memory
-        self._decompressor = deflate.DeflateIO(self._orig_f, deflate.AUTO)
+        '''Reset the decompressor, collecting first if there may not be room for its window.'''
+        self._decompressor = None  # so a collection can free the previous window
+        _memory.reserve(_WINDOW)
+        self._decompressor = _platform.inflater(self._orig_f, self._orig_f_pos)
 
     def read(self, nbytes):
         '''Reads and decompresses data in chunks.'''
@@ -76,7 +255,6 @@ class DecompIO:
         '''Seek to a specific position in the decompressed data stream.'''
         if pos < self._pos:
             # Reset and restart decompression if seeking backwards
-            print("Resetting decompression for seeking...")
             self._orig_f.seek(self._orig_f_pos)  # Rewind to the original position
             self._pos = 0  # Reset position
             self._reset_decompressor()  # Reset the decompressor
@@ -95,8 +273,110 @@ class DecompIO:
 
     def close(self):
         '''Explicitly close the decompressor and release resources.'''
-        self.kill()  # Release memory and force garbage collection
-        print("Decompression stream closed.")
+        self._decompressor = None
+
+class _ZlibReader:
+  '''
+    Stands in for deflate.DeflateIO where there's zlib (ie: CPython), inflating straight from the mapping of a
+    ``_MappedPack``, or reading a plain file from where this stream left off.
+  '''
+
+  def __init__(self, f, pos):
+    import zlib
+    self._f = f
+    self._pos = pos
+    self._d = zlib.decompressobj()
+    self._mapped = hasattr(f, 'view')
+
+  def read(self, nbytes):
+    d = self._d
+    ret = bytearray()
+    while len(ret) < nbytes and not d.eof:
+      data = d.unconsumed_tail
+      if not data:
+        if self._mapped:
+          data = self._f.view[self._pos:self._pos+16384]
+        else:
+          self._f.seek(self._pos)
+          data = self._f.read(4096)
+        if not data: break
+        self._pos += len(data)
+      ret += d.decompress(data, nbytes-len(ret))
+    if d.eof: # leave the file just past this object, as DeflateIO would
+      self._f.seek(self._pos - len(d.unused_data))
+    return ret
+
+
+class _MappedPack:
+  '''
+    A memory mapped pack file.  Supports read/seek/tell like a file, but headers are decoded and objects
+    inflated directly from the mapping.  See ``_CPython.open_pack()``.
+  '''
+
+  def __init__(self, fn):
+    import mmap
+    self._f = open(fn, 'rb', buffering=0) # only for its fileno(), so w/o a read buffer
+    try:
+      self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+    except:
+      self._f.close()
+      raise
+    self.view = memoryview(self._map)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
+
+  def close(self):
+    try:
+      self.view.release()
+      self._map.close()
+    except BufferError: # a slice is still referenced (ex: from a traceback), so leave it to the GC
+      pass
+    self._f.close()
+
+  def read(self, nbytes):
+    return self._map.read(nbytes)
+
+  def seek(self, pos):
+    self._map.seek(pos)
+
+  def tell(self):
+    return self._map.tell()
+
+  def kind_size(self):
+    view, pos = self.view, self._map.tell()
+    byt = view[pos]
+    kind = (byt & 0x70) >> 4
+    size = byt & 0x0F
+    shift = 4
+    while byt & 0x80:
+      pos += 1
+      byt = view[pos]
+      size += (byt & 0x7F) << shift
+      shift += 7
+    self._map.seek(pos+1)
+    return kind, size
+
+  def inflate(self, pos, size):
+    '''Inflates size bytes of the zlib stream at pos, a window at a time so zlib never copies the rest of the pack.'''
+    return _ZlibReader(self, pos).read(size)
+
+  def offset(self):
+    view, pos = self.view, self._map.tell()
+    offset = 0
+    while True:
+      byt = view[pos]
+      pos += 1
+      offset = (offset << 7) | (byt & 0x7f)
+      if byt & 0x80 == 0:
+        break
+      offset += 1
+    self._map.seek(pos)
+    return offset
+
 
 try:
   from btree import open as btree
@@ -108,7 +388,6 @@ except NameError:
   FileNotFoundError = OSError
 
 _Commit = collections.namedtuple("Commit", ('tree', 'parents', 'author', 'committer', 'message'))
-_Entry = collections.namedtuple("Entry", ('mode', 'fn', 'sig'))
 
 class DB:
   '''Context manager for the btree database.'''
@@ -153,7 +432,8 @@ class DB:
     del self._db[key]
 
   def keys(self):
-    return self._db.keys()
+    # btree iterates in key order, so make the pickle fallback match
+    return self._db.keys() if hasattr(self._db, 'close') else sorted(self._db.keys())
 
   def values(self):
     return self._db.values()
@@ -172,14 +452,277 @@ class DB:
       self._db.flush()
      
 
-def _read_headers(x):
-  while line:=x.readline():
-    #print('resp header', line)
-    if line.startswith(b'HTTP/1.0') and not line.startswith(b'HTTP/1.0 200'):
-      raise Exception(line.decode().strip())
-    if not line.strip(): break
+class _PackedRefs:
+  '''
+    Context manager that updates a packed-refs file (``<hex sha> <ref>`` lines, in the server's advertised order,
+    which is sorted) from a new ref advertisement, but only if it changed.  Each ``add()``-ed ref is compared
+    against the old file as it arrives, and a new file is only started at the first difference.  If the
+    advertisement matches, nothing is written at all.  ``changed`` says which happened.
+  '''
+
+  def __init__(self, fn):
+    self._fn = fn
+    self._new = None
+    self._matched = 0 # bytes of the old file the advertisement has matched so far
+    self.changed = False
+
+  def __enter__(self):
+    try:
+      self._old = open(self._fn, 'rb')
+    except OSError:
+      self._old = None
+    return self
+
+  def add(self, ref, sha):
+    line = binascii.hexlify(sha) + b' ' + ref + b'\n'
+    if self._new is None:
+      if self._old and self._old.read(len(line))==line:
+        self._matched += len(line)
+        return
+      self._start_new()
+    self._new.write(line)
+
+  def _start_new(self):
+    self._new = open(self._fn+'.new', 'wb')
+    if self._old:
+      self._old.seek(0)
+      n = self._matched
+      while n:
+        data = self._old.read(min(n, 1024))
+        self._new.write(data)
+        n -= len(data)
+
+  def __exit__(self, type, value, traceback):
+    if self._new is None and not type:
+      if self._old is None or self._old.read(1): # the first advertisement, or refs were removed
+        self._start_new()
+    if self._old: self._old.close()
+    if self._new is None: return
+    self._new.close()
+    if type:
+      os.remove(self._fn+'.new')
+      return
+    _replace(self._fn+'.new', self._fn)
+    self.changed = True
+
+
+class _MicroPython:
+  '''
+    Platform services, each imported the first time it's needed, so scripts that only call ``status()`` or
+    ``log()`` don't load the TLS, AES or inflate stack.
+  '''
+
+  def inflater(self, f, pos):
+    '''A reader inflating the zlib stream at pos in f.'''
+    import deflate
+    f.seek(pos)
+    return deflate.DeflateIO(f, deflate.AUTO)
+
+  def gzip(self, out):
+    '''A writer gzipping into out.  Call close() to finish the stream.'''
+    import deflate
+    return deflate.DeflateIO(out, deflate.GZIP)
+
+  def open_pack(self, fn):
+    '''Opens a pack file for reading.'''
+    return open(fn, 'rb')
+
+  def pack_stream(self, sink, spool_fn):
+    '''A ``_PackStream`` for ephemeral checkouts, spooling what it can't yet inflate to spool_fn.'''
+    return _SpooledPackStream(sink, spool_fn)
+
+  def unique_id(self):
+    import machine
+    return machine.unique_id()
+
+  def cipher(self):
+    '''For credentials stored in the config, keyed to this device.'''
+    import cryptolib
+    return cryptolib.aes(b'ygit'+binascii.hexlify(self.unique_id()), 1)
+
+  def wrap_socket(self, s, host):
+    import ssl
+    return ssl.wrap_socket(s)
+
+  async def open_connection(self, host, port, tls):
+    '''Returns the (reader, writer) streams of a connection to host.'''
+    if not tls:
+      return await asyncio.open_connection(host, port)
+    try:
+      return await asyncio.open_connection(host, port, ssl=True)
+    except TypeError: # uasyncio w/o TLS support in open_connection()
+      import socket
+      s = socket.socket()
+      s.connect((host, port))
+      s = self.wrap_socket(s, host)
+      s.setblocking(False)
+      stream = asyncio.StreamReader(s)
+      return stream, stream
+
+
+class _CPython(_MicroPython):
+  '''The same services from the standard library.'''
+
+  def inflater(self, f, pos):
+    return _ZlibReader(f, pos)
+
+  def gzip(self, out):
+    return _GzipWriter(out)
+
+  def open_pack(self, fn):
+    '''Memory mapped, so headers are decoded and objects inflated straight from the mapping.'''
+    try:
+      return _MappedPack(fn)
+    except (ImportError, OSError, ValueError): # ex: empty files can't be mapped
+      pass
+    return open(fn, 'rb')
+
+  def pack_stream(self, sink, spool_fn):
+    return _PackStream(sink)
+
+  def unique_id(self):
+    import uuid
+    return uuid.getnode().to_bytes(6, 'big')
+
+  def cipher(self):
+    return _HashCipher(b'ygit'+binascii.hexlify(self.unique_id()))
+
+  def wrap_socket(self, s, host):
+    import ssl
+    return ssl.create_default_context().wrap_socket(s, server_hostname=host)
+
+  async def open_connection(self, host, port, tls):
+    '''W/ asyncio's buffering capped at ``_READ_LIMIT``, instead of 64k buffered and 256k per socket read.'''
+    x, w = await asyncio.open_connection(host, port, ssl=True if tls else None, limit=_READ_LIMIT)
+    w.transport.max_size = _READ_LIMIT
+    return x, w
+
+
+class _HashCipher:
+  '''
+    Stands in for ``cryptolib.aes`` (which CPython lacks), XORing w/ a SHA-256 keystream.  As w/ the AES key on a
+    device, the key comes from the machine id, so this only keeps credentials from being stored in the clear.
+  '''
+
+  def __init__(self, key):
+    self._key = key
+
+  def encrypt(self, data):
+    out = bytearray(data)
+    for i in range(0, len(out), 32):
+      block = hashlib.sha256(self._key + i.to_bytes(8, 'big')).digest()
+      for j in range(min(32, len(out)-i)):
+        out[i+j] ^= block[j]
+    return bytes(out)
+
+  decrypt = encrypt
+
+
+_READ_LIMIT = 16*1024 # how much of the server's response CPython's asyncio may buffer
+
+_platform = _MicroPython() if sys.implementation.name=='micropython' else _CPython()
+
+
+async def _close(w):
+  w.close()
+  try:
+    await w.wait_closed()
+  except OSError:
+    pass # TLS shutdown errors don't matter, we have our data
+
+
+_TIMEOUT_MS = 30000 # for any one read from the server
+
+
+class _BufferedStream:
+  '''
+    Buffers reads from the server through one fixed size buffer.  Without it every header line and pkt-line
+    length would be its own socket read, and under uasyncio's TLS stream (which has no buffering) its own TLS
+    record operation.  Reads at least as large as the buffer skip it.  Each read from the underlying stream
+    has to finish within timeout_ms.
+  '''
+
+  def __init__(self, x, bufsize=None, timeout_ms=_TIMEOUT_MS):
+    self._x = x
+    self._mv = memoryview(bytearray(bufsize or _buffer_size(4096, minimum=512)))
+    self._start = self._end = 0
+    self._timeout = timeout_ms/1000 if timeout_ms else None
+
+  async def _raw_readinto(self, mv):
+    x = self._x
+    aw = x.readinto(mv) if hasattr(x, 'readinto') else x.read(len(mv)) # CPython's StreamReader has no readinto
+    ret = await asyncio.wait_for(aw, self._timeout) if self._timeout else await aw
+    if isinstance(ret, int): return ret
+    mv[:len(ret)] = ret
+    return len(ret)
+
+  async def _fill(self):
+    mv = self._mv
+    if self._start==self._end:
+      self._start = self._end = 0
+    elif self._end==len(mv):
+      n = self._end - self._start
+      mv[:n] = bytes(mv[self._start:self._end]) # (overlapping)
+      self._start, self._end = 0, n
+    n = await self._raw_readinto(mv[self._end:])
+    self._end += n
+    return n
+
+  async def readinto(self, mv):
+    '''Reads up to len(mv) bytes into mv.  Returns the number read, 0 only at EOF.'''
+    if self._start==self._end:
+      if len(mv) >= len(self._mv):
+        return await self._raw_readinto(mv)
+      if not await self._fill():
+        return 0
+    n = min(len(mv), self._end - self._start)
+    mv[:n] = self._mv[self._start:self._start+n]
+    self._start += n
+    return n
+
+  async def read(self, n):
+    buf = bytearray(n)
+    return bytes(buf[:await self.readinto(memoryview(buf))])
+
+  async def readexactly(self, n):
+    '''Reads n bytes (or fewer, only at EOF).'''
+    buf = bytearray(n)
+    return bytes(buf[:await _readinto(self, memoryview(buf))])
+
+  async def readline(self):
+    line = b''
+    while True:
+      if self._start==self._end and not await self._fill():
+        return line
+      chunk = bytes(self._mv[self._start:min(self._end, self._start+256)])
+      i = chunk.find(b'\n')
+      if i >= 0:
+        self._start += i+1
+        return line + chunk[:i+1]
+      self._start += len(chunk)
+      line += chunk
+
+
+async def _read_headers(x, headers=None, ok=(200,)):
+  '''Reads the response status and headers (into the headers dict, w/ lowercase names if given).  Returns the status.'''
+  status = None
+  while line:=await x.readline():
+    if status is None and line.startswith(b'HTTP/'):
+      status = int(line.split()[1])
+      if status not in ok:
+        raise Exception(line.decode().strip())
+    elif not line.strip(): break
+    elif headers is not None and b':' in line:
+      k, v = line.split(b':', 1)
+      headers[k.strip().lower().decode()] = v.strip().decode()
+  return status
+
+
+def _pkt_line(data):
+  return f'{len(data)+4:04x}'.encode() + data
 
 def _read_kind_size(f):
+  if hasattr(f, 'kind_size'): return f.kind_size()
   byt = struct.unpack("B", f.read(1))[0]
   kind = (byt & 0x70) >> 4
   size = byt & 0x0F
@@ -201,6 +744,7 @@ def _read_little_size(f):
   return size
 
 def _read_offset(f):
+  if hasattr(f, 'offset'): return f.offset()
   offset = 0
   while True:
     byt = f.read(1)[0]
@@ -214,13 +758,18 @@ def _read_offset(f):
 _ODSDeltaCmd = collections.namedtuple("_ODSDeltaCmd", ('start','append','base_start','nbytes'))
 
 class _ObjReader:
-  '''Handles reading git objects.  See https://git-scm.com/docs/pack-format/2.31.0'''
+  '''
+    Handles reading git objects.  See https://git-scm.com/docs/pack-format/2.31.0
+
+    :param find: Looks up the base of a REF_DELTA (from a thin pack) by its sha.  See ``Repo._object_finder()``.
+  '''
 
-  def __init__(self, f):
+  def __init__(self, f, find=None):
     self.f = f
+    self._find = find
     self.start = f.tell()
     self.kind, self.size = _read_kind_size(f)
-    if self.kind==6:
+    if self.kind in (6,7):
       self._parse_ods_delta()
       self.end = f.tell()
     else:
@@ -229,12 +778,15 @@ class _ObjReader:
   # https://git-scm.com/docs/pack-format#_deltified_representation
   def _parse_ods_delta(self):
     if hasattr(self, 'cmds'): return
-    offset = _read_offset(self.f)
-    self.base_object_offset = self.start - offset
-    return_to = self.f.tell()
-    self.f.seek(self.base_object_offset)
-    self.base_obj = _ObjReader(self.f)
-    self.f.seek(return_to)
+    if self.kind==7:
+      self.base_obj = _find_base(self._find, self.f.read(20))
+    else:
+      offset = _read_offset(self.f)
+      self.base_object_offset = self.start - offset
+      return_to = self.f.tell()
+      self.f.seek(self.base_object_offset)
+      self.base_obj = _ObjReader(self.f, self._find)
+      self.f.seek(return_to)
     
     #print(self, 'about to creat dec_stream in _parse_ods_delta')
     dec_stream = DecompIO(self.f)
@@ -255,7 +807,7 @@ class _ObjReader:
           else:
             vals.write(b'\x00')
         start = int.from_bytes(vals.getvalue()[0:4], 'little')
-        nbytes = int.from_bytes(vals.getvalue()[4:6], 'little')
+        nbytes = int.from_bytes(vals.getvalue()[4:7], 'little')
         if nbytes == 0:
           nbytes = 0x10000
         self.cmds.append(_ODSDeltaCmd(pos, None, start, nbytes))
@@ -267,12 +819,12 @@ class _ObjReader:
         self.cmds.append(_ODSDeltaCmd(pos, to_append, None, nbytes))
         pos += nbytes
     #print(self, 'deleting', dec_stream, 'in _parse_ods_delta')
-    gc.collect()
+    dec_stream.close()
 
     #print(f'{self.kind}@{self.start} cmds={len(self.cmds)} => {self.base_obj.kind}@{self.base_obj.start}')
 
   def get_real_kind(self):
-    if self.kind==6:
+    if self.kind in (6,7):
       return self.base_obj.get_real_kind()
     else:
       return self.kind
@@ -281,7 +833,7 @@ class _ObjReader:
     return f'<OR {id(self)} kind={self.kind} start={self.start}>'
 
   def __enter__(self):
-    if self.kind==6: # ofs-delta
+    if self.kind in (6,7): # ofs-delta or ref-delta
       self.base_f = self.base_obj.__enter__()
       self.pos = 0
       return self
@@ -293,7 +845,7 @@ class _ObjReader:
       return self.decompressed_stream
   
   def __exit__(self, type, value, traceback):
-    if self.kind==6:
+    if self.kind in (6,7):
       self.base_obj.__exit__(type, value, traceback)
       self.f.seek(self.end)
     else:
@@ -308,10 +860,10 @@ class _ObjReader:
     ret = io.BytesIO()
 #    print('===============read', nbytes, 'from position',self.pos)
     for cmd in self.cmds:
-      if cmd.start+cmd.nbytes < self.pos: continue
+      if cmd.start+cmd.nbytes <= self.pos: continue
 #      print('cmd',cmd, 'self.pos', self.pos, 'nbytes',nbytes)
       if cmd.append:
-        to_append = cmd.append[self.pos-cmd.start:min(nbytes,cmd.nbytes)]
+        to_append = cmd.append[self.pos-cmd.start:self.pos-cmd.start+nbytes]
       else:
 #        print('cmd.base_start+self.pos-cmd.start', cmd.base_start, self.pos, cmd.start)
         self.base_f.seek(cmd.base_start+self.pos-cmd.start)
@@ -325,7 +877,6 @@ class _ObjReader:
     return ret
 
   def digest(self):
-    print('#',end='')
     kind = self.get_real_kind()
     #print('kind,', self.start, self.kind, kind)
     assert kind in (1,2,3)
@@ -343,68 +894,1251 @@ class _ObjReader:
     return digest
     
   
-def _read_until(f, stop_byte):
-  buf = io.BytesIO()
-  while byt:=f.read(1):
-    buf.write(byt)
-    if byt==stop_byte: break
-  return buf.getvalue()
-
     
-def _parse_pkt_file(git_dir, fn, pkt_id, db):
-  #print(f'_parse_pkt_file({repr(git_dir)}, {repr(fn)}, {repr(pkt_id)}, db)')
-#  pkt_id = int(fn.split('.')[0])
+_KIND_NAMES = {1:b'commit', 2:b'tree', 3:b'blob', 4:b'tag'}
+
+
+def _object_hash(kind, size):
+  h = hashlib.sha1()
+  h.update(_KIND_NAMES[kind])
+  h.update(b' ')
+  h.update(str(size).encode())
+  h.update(b'\x00')
+  return h
+
+
+def _file_hash(fn):
+  '''The blob sha of fn's contents.'''
+  h = _object_hash(3, os.stat(fn)[6])
   with open(fn,'rb') as f:
+    while data:=f.read(1024):
+      h.update(data)
+  return h.digest()
+
+
+class _MissingBase(Exception):
+  '''A REF_DELTA's base isn't in the index, and no checked out file still holds it.'''
+
+
+def _find_base(find, sha):
+  '''The ``_ObjectSource`` of a REF_DELTA's base, or raises ``_MissingBase``.'''
+  base = find(sha) if find else None
+  if base is None:
+    raise _MissingBase(f'delta base {binascii.hexlify(sha).decode()} not found')
+  return base
+
+
+def _ref_base(f, fpos):
+  '''The sha of the REF_DELTA at the bottom of fpos's delta chain, or None if it ends in a whole object.'''
+  while True:
+    f.seek(fpos)
+    kind, size = _read_kind_size(f)
+    if kind==7: return f.read(20)
+    if kind!=6: return None
+    fpos -= _read_offset(f)
+
+
+class _ObjectSource:
+  '''
+    Where an object can be read from: a pack (through ``_ObjReader``), or a checked out file.  Used like
+    ``_ObjReader``, entering it giving a seekable stream of the object's contents.  See ``Repo._object_finder()``.
+  '''
+
+  def __init__(self, kind, size, fn, ostart=None, find=None):
+    self._kind = kind # None for a delta, until get_real_kind()
+    self.size = size
+    self._fn, self._ostart, self._find = fn, ostart, find
+    self._f = self._obj = None
+
+  def get_real_kind(self):
+    if self._kind is None:
+      with _platform.open_pack(self._fn) as f:
+        f.seek(self._ostart)
+        self._kind = _ObjReader(f, self._find).get_real_kind()
+    return self._kind
+
+  def __enter__(self):
+    if self._ostart is None:
+      self._f = open(self._fn, 'rb')
+      return self._f
+    self._f = _platform.open_pack(self._fn)
+    try:
+      self._f.seek(self._ostart)
+      self._obj = _ObjReader(self._f, self._find)
+      return self._obj.__enter__()
+    except:
+      self._f.close()
+      raise
+
+  def __exit__(self, type, value, traceback):
+    if self._obj: self._obj.__exit__(type, value, traceback)
+    self._f.close()
+    self._f = self._obj = None
+
+
+def _inflate(f, pos, size=None):
+  '''Inflates the zlib stream at pos into a new bytearray of (decompressed) size, or all of it if no size.'''
+  if size is None:
+    f.seek(pos)
+    s = DecompIO(f)
+    buf = io.BytesIO()
+    while data := s.read(1024):
+      buf.write(data)
+    return buf.getvalue()
+  if hasattr(f, 'inflate'): return f.inflate(pos, size)
+  f.seek(pos)
+  s = DecompIO(f)
+  buf = bytearray(size)
+  mv = memoryview(buf)
+  n = 0
+  chunk = _buffer_size(4096, minimum=512)
+  while n < size and (data := s.read(min(chunk, size-n))):
+    mv[n:n+len(data)] = data
+    n += len(data)
+  return buf
+
+
+def _varint(buf, pos):
+  size = shift = 0
+  while True:
+    byt = buf[pos]
+    pos += 1
+    size |= (byt & 0x7f) << shift
+    if byt & 0x80 == 0:
+      return size, pos
+    shift += 7
+
+
+def _apply_delta(base, delta):
+  '''Applies an (inflated) OFS_DELTA to the base object's contents.  See https://git-scm.com/docs/pack-format#_deltified_representation'''
+  base = memoryview(base)
+  base_size, pos = _varint(delta, 0)
+  size, pos = _varint(delta, pos)
+  out = bytearray(size)
+  o = 0
+  while pos < len(delta):
+    byt = delta[pos]
+    pos += 1
+    if byt & 0x80: # copy command
+      start = nbytes = 0
+      for i in range(4):
+        if byt & (1 << i):
+          start |= delta[pos] << (8*i)
+          pos += 1
+      for i in range(3):
+        if byt & (0x10 << i):
+          nbytes |= delta[pos] << (8*i)
+          pos += 1
+      if nbytes == 0:
+        nbytes = 0x10000
+      out[o:o+nbytes] = base[start:start+nbytes]
+    elif byt: # append command
+      nbytes = byt
+      out[o:o+nbytes] = delta[pos:pos+nbytes]
+      pos += nbytes
+    else:
+      continue
+    o += nbytes
+  return out
+
+
+class _BlobStream:
+  '''A read-only stream over a blob, from an ``_ObjectSource``.  See ``Repo.open()``.'''
+
+  def __init__(self, source):
+    self._obj = source
+    self._s = source.__enter__()
+    self._f = True
+    self.size = source.size
+    self._pos = 0
+
+  def read(self, nbytes=-1):
+    if nbytes is None or nbytes < 0:
+      nbytes = self.size - self._pos
+    data = self._s.read(min(nbytes, self.size - self._pos))
+    self._pos += len(data)
+    return data
+
+  def close(self):
+    if self._f:
+      self._obj.__exit__(None, None, None)
+      self._f = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
+
+
+class _TarWriter:
+  '''Writes a ustar archive to out, one entry at a time.  Entries' contents are streamed, so their size must be known up front.'''
+
+  def __init__(self, out, mtime=0):
+    self._out = out
+    self._mtime = mtime
+    self._written = 0
+
+  def add(self, name, mode, size=0, src=None, kind=b'0', link=''):
+    '''
+      :param mode: The git mode (``100644``, ``100755``, ``40000`` or ``120000``).
+      :param src: Read (w/ ``read(n)``) for the entry's contents.
+    '''
+    link = link.encode()
+    if len(link) > 100: # too long for the header, so precede it w/ a GNU long link entry (as tar and Python's tarfile read)
+      self.add('././@LongLink', 100644, len(link)+1, io.BytesIO(link+b'\0'), kind=b'K')
+      link = link[:100]
+    name = name.encode()
+    prefix = b''
+    if len(name) > 100:
+      i = name.rfind(b'/', 0, 156)
+      if i < 0 or len(name)-i-1 > 100:
+        raise Exception(f'path too long for tar: {name.decode()}')
+      prefix, name = name[:i], name[i+1:]
+    header = bytearray(512)
+    def put(pos, value):
+      header[pos:pos+len(value)] = value
+    put(0, name)
+    put(100, ('%07o\0' % (0o755 if mode in (100755, 40000) else 0o644)).encode())
+    put(108, b'0000000\0')
+    put(116, b'0000000\0')
+    put(124, ('%011o\0' % size).encode())
+    put(136, ('%011o\0' % self._mtime).encode())
+    put(148, b' '*8)
+    put(156, kind)
+    put(157, link)
+    put(257, b'ustar\x0000')
+    put(345, prefix)
+    put(148, ('%06o\0 ' % sum(header)).encode())
+    self._write(header)
+    n = 0
+    while n < size and (data := src.read(min(4096, size-n))):
+      self._write(data)
+      n += len(data)
+    if n!=size:
+      raise Exception(f'{name.decode()} ended early')
+    if size % 512:
+      self._write(bytes(512 - size % 512))
+
+  def _write(self, data):
+    self._out.write(data)
+    self._written += len(data)
+
+  def close(self):
+    '''Writes the end of archive marker, padded to a whole 10 KiB record like ``git archive``.'''
+    self._write(bytes(1024))
+    if self._written % 10240:
+      self._write(bytes(10240 - self._written % 10240))
+
+
+class _GzipWriter:
+  '''Gzips what's written to it into out w/ zlib, as deflate.DeflateIO does on MicroPython.'''
+
+  def __init__(self, out):
+    import zlib
+    self._out = out
+    self._z = zlib.compressobj(9, zlib.DEFLATED, 31)
+
+  def write(self, data):
+    self._out.write(self._z.compress(data))
+
+  def close(self):
+    self._out.write(self._z.flush())
+
+
+def _read_object(f, fpos, find=None):
+  '''
+    Reads a whole object into memory, applying its delta chain (if any).  Returns (kind, content).
+
+    :param find: Looks up the base of a REF_DELTA (from a thin pack).  See ``Repo._object_finder()``.
+  '''
+  chain = []
+  while True:
+    f.seek(fpos)
+    kind, size = _read_kind_size(f)
+    if kind != 6: break
+    base_fpos = fpos - _read_offset(f)
+    chain.append(f.tell())
+    fpos = base_fpos
+  if kind==7:
+    base = _find_base(find, f.read(20))
+    chain.append(f.tell())
+    kind = base.get_real_kind()
+    with base as bf:
+      content = bf.read(base.size)
+  else:
+    content = _inflate(f, f.tell(), size)
+  for start in reversed(chain):
+    content = _apply_delta(content, _inflate(f, start))
+  return kind, content
+
+
+def _parse_tree(data):
+  '''Splits a tree object into compact (mode, name, sig) tuples, w/ mode as an int.'''
+  data = bytes(data) # inflated and delta'd objects are bytearrays, which have no find() (or int()) on MicroPython
+  entries = []
+  pos = 0
+  while pos < len(data):
+    sp = data.find(b' ', pos)
+    nul = data.find(b'\x00', sp)
+    entries.append((int(data[pos:sp]), data[sp+1:nul].decode(), data[nul+1:nul+21]))
+    pos = nul+21
+  return entries
+
+
+class _PathMatcher:
+  '''
+    Decides which repo paths a (cone / sparse) checkout includes.  Sparse patterns are repo relative paths
+    (files or directories), ``!`` prefixed to exclude; the deepest matching pattern wins.  They're compiled once
+    into a trie of path components, so whole directories can be accepted or rejected without looking inside.
+  '''
+
+  def __init__(self, cone=None, sparse=None):
+    self.cone = cone
+    self.root = [{}, None, False] # children, rule (True include / False exclude / None), includes below
+    includes = False
+    for pattern in sparse or ():
+      rule = not pattern.startswith('!')
+      includes = includes or rule
+      node = self.root
+      for part in pattern.lstrip('!').strip('/').split('/'):
+        if rule: node[2] = True
+        node = node[0].setdefault(part, [{}, None, False])
+      node[1] = rule
+    self.default = not includes
+    self.restricted = bool(cone or sparse)
+
+  def _lookup(self, path):
+    decision = self.default
+    node = self.root
+    for part in path.split('/') if path else ():
+      node = node[0].get(part)
+      if node is None: return decision, None
+      if node[1] is not None: decision = node[1]
+    return decision, node
+
+  def match(self, path):
+    '''True if the file at this repo relative path is checked out.'''
+    if self.cone and not path.startswith(self.cone): return False
+    return self._lookup(path)[0]
+
+  def prune(self, path):
+    '''True if nothing under the directory at this repo relative path can be checked out.'''
+    if self.cone:
+      d = path + '/'
+      if not (d.startswith(self.cone) or self.cone.startswith(d)): return True
+    decision, node = self._lookup(path)
+    return not decision and not (node and node[2])
+
+
+async def _parse_pkt_file(git_dir, fn, pkt_id, db, events=_NULL_EVENTS, slicer=None, workers=None, find=None):
+  '''
+    Indexes a pack file, like ``git index-pack``.
+
+    The first pass hashes every whole object and records where each delta is and what its base is.  The
+    second walks each delta tree depth-first from its base, so every base is inflated once and all its
+    children are applied while it's in memory.  Memory is bounded by the chain depth; chains too large for
+    the free heap (and any deltas beyond what we can afford to keep track of) fall back to streaming each
+    object through ``_ObjReader``.  So do REF_DELTAs (and their trees), whose bases are outside a thin pack.
+
+    :param workers: On CPython, resolve the delta trees in a pool of this many processes, each reading the
+      memory mapped pack.  Their records are added in the same order as w/o, so the index is identical.
+    :param find: Looks up REF_DELTA bases.  See ``Repo._object_finder()``.
+    :return: How many deltas weren't indexed, since their base couldn't be found.
+  '''
+  missing = 0
+  with _platform.open_pack(fn) as f:
     assert f.read(4)==b'PACK'
     version = struct.unpack('!I', f.read(4))[0]
     cnt = struct.unpack('!I', f.read(4))[0]
-    #print('reading', cnt, 'objs from', fn)
+    deltas = {} # fpos -> (delta zlib start, end, result size, inflated delta size)
+    children = {} # base fpos -> [delta fpos, ...]
+    refs = [] # fpos of each REF_DELTA
+    max_deltas = _buffer_size(1<<24, fraction=256, minimum=16)
+    indexed = 0
     for i in range(cnt):
       fpos = f.tell()
-      o = _ObjReader(f)
-      kind = o.kind
-      size = o.size
+      kind, size = _read_kind_size(f)
       assert kind!=0
-      idx = struct.pack('QBQQQ', pkt_id, kind, f.tell(), size, fpos)
-      sig = o.digest()
-      db[sig] = idx
-    print()
+      if kind==7:
+        refs.append(fpos)
+        f.read(20)
+        _skip_stream(f)
+      elif kind==6 and len(deltas) < max_deltas:
+        base_fpos = fpos - _read_offset(f)
+        start = f.tell()
+        s = DecompIO(f)
+        _read_little_size(s) # base size
+        size = _read_little_size(s)
+        while s.read(1024): pass
+        deltas[fpos] = (start, f.tell(), size, s._pos)
+        children.setdefault(base_fpos, []).append(fpos)
+      elif kind==6:
+        f.seek(fpos)
+        try:
+          o = _ObjReader(f, find)
+        except _MissingBase:
+          missing += 1
+          f.seek(fpos)
+          _read_kind_size(f)
+          _read_offset(f)
+          _skip_stream(f)
+          continue
+        db[o.digest()] = struct.pack('QBQQQ', pkt_id, kind, o.end, o.size, fpos)
+        f.seek(o.end)
+        indexed += 1
+      else:
+        start = f.tell()
+        h = _object_hash(kind, size)
+        s = DecompIO(f)
+        while data := s.read(1024):
+          h.update(data)
+        db[h.digest()] = struct.pack('QBQQQ', pkt_id, kind, start, size, fpos)
+        indexed += 1
+      events.event(OBJECTS, indexed)
+      if slicer: await slicer.tick()
     #TODO parse tail, which is hash of packet
     #print('done at', f.tell(), 'remaining', len(f.read()))
 
+    budget = _buffer_size(1<<26, fraction=4, minimum=1024)
+    ref_set = set(refs)
+    roots = [root for root in sorted(children) if root not in deltas and root not in ref_set] # the rest are resolved from their base
+    if workers and isinstance(f, _MappedPack) and len(roots) > 1:
+      import concurrent.futures
+      with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(_resolve_delta_trees, fn, batch, *_delta_forest(batch, deltas, children), pkt_id, budget)
+                   for batch in _batches(roots, children, len(deltas)//(workers*4)+1)]
+        for future in futures:
+          indexed = await _store(db, await asyncio.wrap_future(future), indexed, events, slicer)
+    else:
+      for root in roots:
+        indexed = await _store(db, _resolve_delta_tree(f, root, deltas, children, pkt_id, budget), indexed, events, slicer)
+    for fpos in refs:
+      try:
+        records = list(_stream_delta_tree(f, fpos, children, pkt_id, find))
+      except _MissingBase:
+        missing += 1
+        continue
+      indexed = await _store(db, records, indexed, events, slicer)
+  return missing
+
+
+def _skip_stream(f):
+  '''Reads f past the zlib stream it's at.'''
+  s = DecompIO(f)
+  while s.read(1024): pass
+
+
+async def _store(db, records, indexed, events, slicer):
+  '''Adds (key, value) records to the index, reporting progress.  Returns the new count.'''
+  for key, value in records:
+    db[key] = value
+    indexed += 1
+    events.event(OBJECTS, indexed)
+    if slicer: await slicer.tick()
+  return indexed
+
+
+def _resolve_delta_tree(f, root, deltas, children, pkt_id, budget):
+  '''Yields the (digest, index record) of every delta below root, in the order ``_parse_pkt_file()`` adds them.'''
+  f.seek(root)
+  kind, size = _read_kind_size(f)
+  content = _inflate(f, f.tell(), size) if size <= budget else None
+  stack = [(content, iter(children[root]))]
+  held = size
+  while stack:
+    base, todo = stack[-1]
+    child = next(todo, None)
+    if child is None:
+      stack.pop()
+      if base is not None: held -= len(base)
+      continue
+    start, end, size, delta_size = deltas[child]
+    if base is None or held + size + delta_size > budget:
+      yield from _stream_delta_tree(f, child, children, pkt_id)
+      continue
+    content = _apply_delta(base, _inflate(f, start, delta_size))
+    h = _object_hash(kind, size)
+    h.update(content)
+    yield h.digest(), struct.pack('QBQQQ', pkt_id, 6, end, size, child)
+    if child in children:
+      stack.append((content, iter(children[child])))
+      held += size
+    del content
+
+
+def _stream_delta_tree(f, fpos, children, pkt_id, find=None):
+  '''Like ``_resolve_delta_tree()`` the slow (but memory-light) way, each delta through its own ``_ObjReader`` chain.'''
+  todo = [fpos]
+  while todo:
+    fpos = todo.pop()
+    f.seek(fpos)
+    o = _ObjReader(f, find)
+    yield o.digest(), struct.pack('QBQQQ', pkt_id, o.kind, o.end, o.size, fpos)
+    todo.extend(children.get(fpos, ()))
+
+
+def _delta_forest(roots, deltas, children):
+  '''The parts of deltas and children below roots, to send to a worker process.'''
+  sub_deltas, sub_children = {}, {}
+  todo = list(roots)
+  while todo:
+    fpos = todo.pop()
+    if fpos in children:
+      sub_children[fpos] = children[fpos]
+      todo.extend(children[fpos])
+    if fpos in deltas:
+      sub_deltas[fpos] = deltas[fpos]
+  return sub_deltas, sub_children
+
+
+def _batches(roots, children, size):
+  '''Splits roots (in order) into runs whose trees hold about size deltas each.'''
+  batch, n = [], 0
+  for root in roots:
+    batch.append(root)
+    todo = [root]
+    while todo:
+      for child in children.get(todo.pop(), ()):
+        n += 1
+        todo.append(child)
+    if n >= size:
+      yield batch
+      batch, n = [], 0
+  if batch:
+    yield batch
+
+
+def _resolve_delta_trees(fn, roots, deltas, children, pkt_id, budget):
+  '''Runs in a worker process: all the records of ``_resolve_delta_tree()`` for each of roots, in order.'''
+  with _platform.open_pack(fn) as f:
+    return [record for root in roots for record in _resolve_delta_tree(f, root, deltas, children, pkt_id, budget)]
+
+
+def _buffer_size(limit, fraction=8, minimum=256):
+  '''A buffer size up to limit that fits comfortably in free memory.'''
+  free = gc.mem_free()
+  return limit if not free else max(minimum, min(limit, free//fraction))
+
+
+async def _readinto(x, mv):
+  '''Fills mv from ``_BufferedStream`` x (short only at EOF).  Returns the number of bytes read.'''
+  n = 0
+  while n < len(mv):
+    r = await x.readinto(mv[n:])
+    if not r: break
+    n += r
+  return n
+
+
+def _hex4(mv):
+  '''Parses a pkt-line length w/o allocating.'''
+  n = 0
+  for c in mv[:4]:
+    n = (n << 4) | (c-48 if c<58 else (c|32)-87)
+  return n
+
+
+class _PktLines:
+  '''
+    Async iterator over the pkt-lines of an asyncio stream.
+
+    Everything is read through one preallocated buffer.  Sideband channel 1 (pack data) is written straight
+    from it to ``f``, channel 2 (progress) becomes ``MESSAGE`` events, channel 3 (errors) is raised, and
+    anything else is yielded.  Sideband packets can be up to 65520 bytes, but the buffer is sized to the
+    free heap, so larger packets are copied through in pieces.
+  '''
 
-def _iter_pkt_lines(x, f=None):
-  ticks = False
-  while pkt_bytes := x.read(4):
-    pkt_bytes = int(pkt_bytes,16)
-    pkt_bytes -= 4
-    if pkt_bytes>0:
-      buf = io.BytesIO()
-      channel = x.read(1)
+  def __init__(self, x, f=None, events=_NULL_EVENTS, slicer=None, bufsize=None):
+    self._x = x
+    self._f = f
+    self._events = events
+    self._slicer = slicer
+    self._mv = memoryview(bytearray(bufsize or _buffer_size(65520)))
+    self._received = 0
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    x, mv = self._x, self._mv
+    while await _readinto(x, mv[:4])==4:
+      if self._slicer: await self._slicer.tick()
+      pkt_bytes = _hex4(mv) - 4
+      if pkt_bytes<=0: continue # flush / delim / response-end
+      if not await _readinto(x, mv[:1]): break
+      channel = mv[0]
       pkt_bytes -= 1
-      if channel==b'\x01':
-        while pkt_bytes>0:
-          data = x.read(min(128,pkt_bytes))
-          pkt_bytes -= len(data)
-          if f: f.write(data)
-#        print('>',end='')
-        if ticks:
-          sys.stdout.write('>')
-        else:
-          ticks = True
-          # skip the first tick
+      if channel==1:
+        await self._copy(pkt_bytes)
+      elif channel==2:
+        self._events.event(MESSAGE, (await self._read(pkt_bytes)).decode().strip())
+      elif channel==3:
+        raise Exception((await self._read(pkt_bytes)).decode().strip())
+      else:
+        return bytes((channel,)) + await self._read(pkt_bytes)
+    raise StopAsyncIteration
+
+  async def _copy(self, pkt_bytes):
+    mv = self._mv
+    while pkt_bytes>0:
+      n = await _readinto(self._x, mv[:min(pkt_bytes, len(mv))])
+      if not n: break
+      if self._f: self._f.write(mv[:n])
+      pkt_bytes -= n
+      self._received += n
+    self._events.event(BYTES, self._received)
+
+  async def _read(self, pkt_bytes):
+    data = b''
+    mv = self._mv
+    while pkt_bytes>0:
+      n = await _readinto(self._x, mv[:min(pkt_bytes, len(mv))])
+      if not n: break
+      data += bytes(mv[:n])
+      pkt_bytes -= n
+    return data
+
+
+def _parse_obj_header(f):
+  '''Reads a pack object header from f.  Returns (kind, size, base), or None if f ends first.'''
+  try:
+    kind, size = _read_kind_size(f)
+    base = None
+    if kind==6:
+      base = _read_offset(f)
+    elif kind==7:
+      base = f.read(20)
+      if len(base)<20: return None
+    return kind, size, base
+  except (IndexError, struct.error):
+    return None
+
+
+class _PackStream:
+  '''
+    Parses a pack as it's written to it (see ``_PktLines``), w/o ever storing it.  Each object is inflated
+    w/ zlib.decompressobj as its bytes arrive, and handed to ``sink`` as ``sink.start(pos, kind, size, base)``,
+    then ``sink.write(data)`` per inflated chunk, then ``sink.end()``.  For OFS_DELTAs base is the offset back
+    to the base object, for REF_DELTAs its binary sha.
+  '''
+
+  def __init__(self, sink):
+    self._sink = sink
+    self._buf = b''     # header bytes not yet parsed
+    self._pos = 0       # pack offset of _buf[0]
+    self._remaining = None
+    self._d = None
+
+  def write(self, data):
+    while data:
+      if self._d is None:
+        self._buf += data
+        data = self._next_object()
+        if data is None: return
+      data = self._inflate(data)
+
+  def _next_object(self):
+    '''Starts the next object if its header has arrived, returning the bytes after the header.'''
+    import zlib
+    buf = self._buf
+    if self._remaining is None:
+      if len(buf)<12: return None
+      if buf[:4]!=b'PACK': raise Exception('not a pack')
+      self._remaining = struct.unpack('>I', buf[8:12])[0]
+      buf = self._buf = buf[12:]
+      self._pos = 12
+    if not self._remaining: # just the trailing checksum left
+      self._buf = b''
+      return None
+    f = io.BytesIO(buf)
+    header = _parse_obj_header(f)
+    if header is None: return None
+    self._remaining -= 1
+    self._sink.start(self._pos, *header)
+    self._pos += f.tell()
+    self._buf = b''
+    self._d = zlib.decompressobj()
+    return buf[f.tell():]
+
+  def _inflate(self, data):
+    '''Inflates what it can of data into the current object, returning any bytes after its end.'''
+    d = self._d
+    n = len(data)
+    while data and not d.eof:
+      chunk = d.decompress(data, 4096)
+      if chunk: self._sink.write(chunk)
+      data = d.unconsumed_tail
+    if not d.eof:
+      self._pos += n
+      return None
+    rest = d.unused_data
+    self._pos += n - len(rest)
+    self._d = None
+    self._sink.end()
+    return rest
+
+  def close(self):
+    if self._remaining is None or self._remaining or self._d:
+      raise Exception('pack ended early')
+
+
+class _SpooledPackStream(_PackStream):
+  '''
+    ``_PackStream`` for where there's no zlib.decompressobj (ie: MicroPython).  Data is appended to a small
+    spool file, and each object is inflated w/ deflate.DeflateIO from its start once enough has arrived.  An
+    object is only known to be complete once data past its end has arrived, so failed attempts are retried
+    each time its spooled bytes double (calling ``sink.start()`` again for the same object).  Once what's been
+    consumed outgrows what hasn't, the rest is moved to a fresh spool, so it only ever holds about two objects.
+  '''
+
+  def __init__(self, sink, spool_fn):
+    super().__init__(sink)
+    self._fns = (spool_fn, spool_fn+'.1') # alternated between by _compact()
+    self._fn = spool_fn
+    self._f = open(spool_fn, 'w+b')
+    self._start = 0    # spool offset of the next unparsed byte
+    self._len = 0
+    self._header = None
+    self._next_try = 0
+
+  def write(self, data):
+    self._f.seek(self._len)
+    self._f.write(data)
+    self._len += len(data)
+    if self._len >= self._next_try:
+      self._drain(False)
+
+  def _drain(self, final):
+    f = self._f
+    while True:
+      f.seek(self._start)
+      if self._remaining is None:
+        header = f.read(12)
+        if len(header)<12: return
+        if header[:4]!=b'PACK': raise Exception('not a pack')
+        self._remaining = struct.unpack('>I', header[8:12])[0]
+        self._start = 12
+        continue
+      if not self._remaining: return
+      if self._header is None:
+        self._header = _parse_obj_header(f)
+        if self._header is None: return
+        self._obj_pos = self._pos + self._start
+        self._data_start = f.tell()
+      if not self._try_inflate(final):
+        self._next_try = self._data_start + 2*max(64, self._len-self._data_start)
+        return
+      self._remaining -= 1
+      self._header = None
+      self._next_try = 0
+      if self._start >= max(4096, self._len-self._start):
+        self._compact()
+        f = self._f
+
+  def _compact(self):
+    '''Moves the unparsed rest of the spool to the start of a new one, and removes the old one.'''
+    old, old_fn = self._f, self._fn
+    self._fn = self._fns[self._fns[0]==old_fn]
+    self._f = open(self._fn, 'w+b')
+    old.seek(self._start)
+    while data := old.read(1024):
+      self._f.write(data)
+    old.close()
+    os.remove(old_fn)
+    self._pos += self._start # _pos is the pack offset of the spool's start
+    self._len -= self._start
+    self._start = 0
+
+  def _try_inflate(self, final):
+    kind, size, base = self._header
+    f = self._f
+    self._sink.start(self._obj_pos, kind, size, base)
+    f.seek(self._data_start)
+    s = _platform.inflater(f, self._data_start)
+    n = 0
+    try:
+      while n<size:
+        data = s.read(min(1024, size-n))
+        if not data: return False
+        self._sink.write(data)
+        n += len(data)
+      s.read(1) # through the end of the stream (and its checksum)
+    except (OSError, EOFError, ValueError):
+      return False
+    end = f.tell()
+    if end>=self._len and not final: return False
+    self._start = end
+    self._sink.end()
+    return True
+
+  def close(self):
+    try:
+      self._drain(True)
+    finally:
+      self._f.close()
+      os.remove(self._fn)
+    if self._remaining is None or self._remaining:
+      raise Exception('pack ended early')
+
+
+def _makedirs(directory):
+  if directory and not _isdir(directory):
+    _makedirs(directory.rsplit('/', 1)[0] if '/' in directory else '')
+    os.mkdir(directory)
+
+
+_MANIFEST_RECORD = '>HHI20sQq' # shared prefix length, suffix length, mode, sha, size, mtime
+
+
+def _stat(fn):
+  '''(size, mtime) of fn, w/ mtime in ns where the platform has it, or None if fn doesn't exist.'''
+  try:
+    st = os.stat(fn)
+  except OSError:
+    return None
+  return st[6], getattr(st, 'st_mtime_ns', st[8])
+
+
+class _Manifest:
+  '''
+    The flattened tree of the checked out commit: one record per file, sorted by its (local) path, w/ its mode,
+    blob sha, and the size and mtime it had when written (a stat cache, to tell if the file has changed since).
+    Each path is stored as the length it shares w/ the previous path plus the rest.  Written once per checkout
+    and read back w/ a sequential scan, so comparing it to the next checkout is a merge-join.
+  '''
+
+  def __init__(self, fn):
+    self.fn = fn
+    self.commit = None
+    self._mtime = None
+    try:
+      with open(fn, 'rb') as f:
+        self.commit = f.readline().strip()
+      self._mtime = _stat(fn)[1]
+    except OSError:
+      pass
+
+  def __iter__(self):
+    '''Yields (local path, mode, sha, size, mtime), in path order.'''
+    if self.commit is None: return
+    n = struct.calcsize(_MANIFEST_RECORD)
+    path = b''
+    with open(self.fn, 'rb') as f:
+      f.readline()
+      while header := f.read(n):
+        shared, length, mode, sha, size, mtime = struct.unpack(_MANIFEST_RECORD, header)
+        path = path[:shared] + f.read(length)
+        yield path.decode(), mode, sha, size, mtime
+
+  def unchanged(self, fn, size, mtime):
+    '''
+      True if fn's stat still matches an entry's.  A file modified in the same tick the manifest was written
+      could have the same mtime either way, so it's never trusted.
+    '''
+    return mtime < self._mtime and _stat(fn)==(size, mtime)
+
+  @staticmethod
+  def write(fn, commit, entries, block=None):
+    '''
+      :param entries: (local path, mode, sha, size, mtime) tuples, sorted by path.
+    '''
+    with _FlashWriter(fn+'.new', block) as f:
+      f.write(commit + b'\n')
+      prev = b''
+      for path, mode, sha, size, mtime in entries:
+        path = path.encode()
+        shared, limit = 0, min(len(prev), len(path), 0xffff)
+        while shared < limit and prev[shared]==path[shared]:
+          shared += 1
+        f.write(struct.pack(_MANIFEST_RECORD, shared, len(path)-shared, mode, sha, size, mtime))
+        f.write(path[shared:])
+        prev = path
+    _replace(fn+'.new', fn)
+
+
+def _next(it):
+  try:
+    return next(it)
+  except StopIteration:
+    return None
+
+
+def _merge_join(old, new):
+  '''Pairs up two iterables of tuples sorted by their first item, yielding (old, new) w/ None for a missing side.'''
+  old, new = iter(old), iter(new)
+  o, n = _next(old), _next(new)
+  while o or n:
+    if n is None or (o is not None and o[0] < n[0]):
+      yield o, None
+      o = _next(old)
+    elif o is None or n[0] < o[0]:
+      yield None, n
+      n = _next(new)
+    else:
+      yield o, n
+      o, n = _next(old), _next(new)
+
+
+class _StreamCheckout:
+  '''
+    The ``_PackStream`` sink for ephemeral clones: checks out one commit as its pack arrives.
+
+    Blobs are inflated into a temp file while being hashed, then renamed to their path(s) in the working
+    tree.  Git sends all trees before any blobs, so the few blobs that arrive before the tree naming them wait in
+    ``.ygit/tmp``.  Once every tree in the checkout has arrived, blobs it doesn't want are dropped as they
+    arrive, and so are commits and trees (blobs are only ever deltas of blobs).  A wanted blob whose delta base
+    was dropped is left in ``missing()``, for the caller to fetch on its own.  Until then commits and trees are
+    kept in memory, up to a budget, and in ``.ygit/tmp`` after that.  Deltas are applied in memory, reading
+    their base back from wherever it was put.  Files whose sha and stat match the previous manifest aren't
+    rewritten.
+  '''
+
+  def __init__(self, repo, commit, matcher, manifest, events):
+    self._repo = repo
+    self._dir = repo._dir
+    self._tmp = f'{repo._git_dir}/tmp'
+    self._commit = binascii.unhexlify(commit)
+    self._matcher = matcher
+    self._manifest = manifest
+    self._old = {entry[0]:entry[1:] for entry in manifest} # local path -> (mode, sha, size, mtime)
+    self._events = events
+    self.manifest = {}    # the same, for this checkout
+    self._offsets = {}    # pack offset -> (sha, kind), for OFS_DELTA bases (sha is None if dropped)
+    self._objects = {}    # sha -> (kind, contents), for commits and trees (contents None if in .ygit/tmp)
+    self._held = 0        # bytes of contents in _objects
+    self._budget = _buffer_size(1<<20, fraction=4, minimum=4096)
+    self._blobs = {}      # sha -> file holding its contents
+    self._want = {}       # sha -> [(local path, mode)], for blobs not yet arrived
+    self._tree_paths = {} # sha -> [repo paths], for trees not yet arrived
+    self._trees_done = False # every tree in the checkout has arrived
+    self._count = 0
+    self._pos = None      # pack offset of the current object
+    self._block = repo._block_size()
+    _makedirs(self._tmp)
+
+  def next_pack(self):
+    '''Called before each pack after the first, since OFS_DELTA bases are only looked up within a pack.'''
+    self._offsets = {}
+    self._pos = None
+
+  def start(self, pos, kind, size, base):
+    if pos==self._pos: # retried by _SpooledPackStream: skip what's already been written
+      self._replay = self._got
+      return
+    self._pos, self._kind, self._size, self._base = pos, kind, size, base
+    self._got = self._replay = 0
+    self._skip = False
+    if kind in (6,7):
+      base_sha, base_kind = self._offsets[pos-base] if kind==6 else (base, self._kind_of(base))
+      self._skip = base_sha is None or (self._trees_done and base_kind!=3)
+      self._base = base_sha, base_kind
+    elif kind!=3:
+      self._skip = self._trees_done
+    if self._skip:
+      return
+    if kind==3:
+      self._h = _object_hash(3, size)
+      self._tmp_fn = f'{self._tmp}/blob'
+      self._f = _FlashWriter(self._tmp_fn, self._block)
+    else:
+      self._chunks = []
+
+  def write(self, data):
+    if self._replay:
+      n = min(self._replay, len(data))
+      self._replay -= n
+      data = data[n:]
+      if not data: return
+    self._got += len(data)
+    if self._skip:
+      pass
+    elif self._kind==3:
+      self._h.update(data)
+      self._f.write(data)
+    else:
+      self._chunks.append(bytes(data))
+
+  def end(self):
+    kind = self._kind
+    if self._skip:
+      sha = None
+      if kind in (6,7): kind = self._base[1]
+    elif kind==3:
+      self._f.close()
+      sha = self._h.digest()
+      sha = self._add_blob(sha, self._tmp_fn)
+    else:
+      content = b''.join(self._chunks)
+      self._chunks = None
+      if kind in (6,7):
+        base_sha, kind = self._base
+        content = _apply_delta(self._load(base_sha, kind), content)
+      h = _object_hash(kind, len(content))
+      h.update(content)
+      sha = h.digest()
+      if kind==3:
+        with _FlashWriter(f'{self._tmp}/blob', self._block) as f:
+          f.write(content)
+        del content
+        sha = self._add_blob(sha, f'{self._tmp}/blob')
+      elif kind==1:
+        self._add_commit(sha, content)
+      elif kind==2:
+        self._add_tree(sha, content)
+    self._offsets[self._pos] = (sha, kind)
+    self._count += 1
+    self._events.event(OBJECTS, self._count)
+
+  def _kind_of(self, sha):
+    if sha in self._blobs: return 3
+    if sha in self._objects: return self._objects[sha][0]
+    if self._trees_done: return None # dropped
+    raise Exception(f'delta base {binascii.hexlify(sha).decode()} not in pack')
+
+  def _load(self, sha, kind):
+    if kind==3:
+      fn = self._blobs[sha]
+    else:
+      kind, content = self._objects[sha]
+      if content is not None: return content
+      fn = f'{self._tmp}/{binascii.hexlify(sha).decode()}'
+    with open(fn, 'rb') as f:
+      return f.read()
+
+  def _hold(self, sha, kind, content):
+    if self._held + len(content) > self._budget:
+      with _FlashWriter(f'{self._tmp}/{binascii.hexlify(sha).decode()}', self._block) as f:
+        f.write(content)
+      content = None
+    else:
+      self._held += len(content)
+    self._objects[sha] = (kind, content)
+
+  def _add_commit(self, sha, content):
+    self._hold(sha, 1, content)
+    if sha!=self._commit: return
+    for line in bytes(content).split(b'\n'):
+      if line.startswith(b'tree '):
+        self._add_tree_path(binascii.unhexlify(line[5:45]), '')
+        break
+    self._check_trees_done()
+
+  def _add_tree(self, sha, content):
+    self._hold(sha, 2, content)
+    for path in self._tree_paths.pop(sha, ()):
+      self._expand(path, content)
+    self._check_trees_done()
+
+  def _add_tree_path(self, sha, path):
+    if sha in self._objects:
+      self._expand(path, self._load(sha, 2))
+    else:
+      self._tree_paths.setdefault(sha, []).append(path)
+
+  def _expand(self, path, content):
+    matcher = self._matcher
+    cone = matcher.cone or ''
+    for mode, name, sig in _parse_tree(content):
+      sub_path = f'{path}/{name}' if path else name
+      if mode==40000:
+        if not matcher.prune(sub_path):
+          self._add_tree_path(sig, sub_path)
+      elif mode==160000:
+        self._events.event(MESSAGE, f'ignoring submodule: {sub_path}')
+      elif matcher.match(sub_path):
+        self._want.setdefault(sig, []).append((sub_path[len(cone):], mode))
+        if sig in self._blobs:
+          self._place(sig)
+
+  def _check_trees_done(self):
+    '''Once the commit and every tree under it have arrived, drops everything the checkout won't use.'''
+    if self._trees_done or self._commit not in self._objects or self._tree_paths: return
+    self._trees_done = True
+    for sha, (kind, content) in self._objects.items():
+      if content is None:
+        os.remove(f'{self._tmp}/{binascii.hexlify(sha).decode()}')
+    self._objects = {}
+    self._held = 0
+    for sha, fn in list(self._blobs.items()):
+      if fn.startswith(self._tmp): # wanted blobs were placed as soon as they were
+        os.remove(fn)
+        del self._blobs[sha]
+
+  def _add_blob(self, sha, fn):
+    '''Places, keeps or drops a blob that's just arrived.  Returns its sha, or None if it was dropped.'''
+    if sha in self._want:
+      self._blobs[sha] = fn
+      self._place(sha)
+    elif sha in self._blobs: # sent twice?
+      os.remove(fn)
+    elif self._trees_done:
+      os.remove(fn)
+      return None
+    else:
+      spill_fn = f'{self._tmp}/{binascii.hexlify(sha).decode()}'
+      os.rename(fn, spill_fn)
+      self._blobs[sha] = spill_fn
+    return sha
+
+  def _place(self, sha):
+    src = self._blobs[sha]
+    for local, mode in self._want.pop(sha):
+      fn = f'{self._dir}/{local}'
+      old = self._old.get(local)
+      if old and old[1]==sha and self._manifest.unchanged(fn, old[2], old[3]):
+        self.manifest[local] = old
+        if src.startswith(self._tmp):
+          os.remove(src)
+          self._blobs[sha] = src = fn
+        continue
+      self._events.event(FILE, (fn, 'BLOB'))
+      _makedirs(fn.rsplit('/', 1)[0])
+      if src.startswith(self._tmp):
+        _replace(src, fn)
+        self._blobs[sha] = src = fn
       else:
-        buf.write(channel)
-        while pkt_bytes>0:
-          bits = x.read(min(128,pkt_bytes))
-          if not bits: break
-          pkt_bytes -= len(bits)
-          buf.write(bits)
-        data = buf.getvalue()
-        if ticks:
-          sys.stdout.write('\n')
-          ticks = False
-        yield data
+        _copy(src, fn, self._block)
+      self.manifest[local] = (mode, sha) + _stat(fn)
+
+  def missing(self):
+    '''The (hex) shas of wanted blobs that haven't been placed, ex: because their delta base was dropped.'''
+    return [binascii.hexlify(sha) for sha in self._want]
+
+  def finish(self):
+    '''Called once the last pack has ended.  Removes files the previous manifest had but this checkout doesn't.'''
+    if not self._trees_done:
+      raise Exception('pack is missing trees')
+    if self._want:
+      missing = ', '.join(local for local, mode in self._want.popitem()[1])
+      raise Exception(f'pack is missing blobs for: {missing}')
+    for local in self._old:
+      if local not in self.manifest:
+        fn = f'{self._dir}/{local}'
+        if _exists(fn) and not _isdir(fn):
+          os.remove(fn)
+    for fn in os.listdir(self._tmp):
+      os.remove(f'{self._tmp}/{fn}')
+    os.rmdir(self._tmp)
+
+
+def _in_event_loop():
+  '''If called from a coroutine, where asyncio.run() would fail.'''
+  try:
+    asyncio.get_running_loop()
+    return True
+  except (AttributeError, RuntimeError): # no loop (or no way to tell, on MicroPython)
+    return False
+
+
+async def _dedupe(shared, key, fn, *args):
+  '''Runs ``fn(*args)`` only once per key in ``shared``, giving every caller the same result.  See ``fetch_many()``.'''
+  if shared is None:
+    return await fn(*args)
+  if key not in shared:
+    shared[key] = asyncio.create_task(fn(*args))
+  return await shared[key]
+
+
+class _Written:
+  '''Running totals of what ``_FlashWriter`` has written, for tracking flash wear (see the ``WRITTEN`` event).'''
+
+  def __init__(self):
+    self.bytes = 0
+    self.blocks = 0
+
+
+_written = _Written()
+
+
+def _block_size(fn):
+  '''The block size of the filesystem fn is (or will be) on.'''
+  try:
+    return os.statvfs(fn.rsplit('/', 1)[0] if '/' in fn else '.')[0] or 4096
+  except (AttributeError, OSError):
+    return 4096
+
+
+class _FlashWriter:
+  '''
+    A file open for writing that coalesces writes into a buffer of whole filesystem blocks, so each small write
+    doesn't cost its own littlefs / FAT block and metadata update.  Only the last write of a file can be partial.
+
+    :param block: The filesystem's block size.  Looked up w/ ``os.statvfs()`` if not given.
+  '''
+
+  def __init__(self, fn, block=None):
+    block = block or _block_size(fn)
+    self._block = block
+    self._mv = memoryview(bytearray(max(1, _buffer_size(4096, minimum=block)//block)*block))
+    self._n = 0
+    self._f = open(fn, 'wb')
+
+  def write(self, data):
+    mv, n = self._mv, len(data)
+    data = memoryview(data)
+    i = 0
+    while i < n:
+      k = min(n-i, len(mv)-self._n)
+      mv[self._n:self._n+k] = data[i:i+k]
+      self._n += k
+      i += k
+      if self._n==len(mv):
+        self._flush()
+    return n
+
+  def copy_from(self, src):
+    '''Reads src (w/ ``read(n)``) to its end, asking for just what fills the rest of the buffer each time.'''
+    while data := src.read(len(self._mv)-self._n):
+      self.write(data)
+
+  def _flush(self):
+    if self._n:
+      self._f.write(self._mv[:self._n])
+      _written.bytes += self._n
+      _written.blocks += (self._n + self._block - 1) // self._block
+      self._n = 0
+
+  def close(self):
+    if self._f:
+      self._flush()
+      self._f.close()
+      self._f = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, type, value, traceback):
+    self.close()
+
+
+def _link(src, dst, block=None):
+  '''Hard links src to dst, or copies it where links aren't supported.'''
+  try:
+    os.link(src, dst)
+  except (AttributeError, OSError):
+    _copy(src, dst, block)
+
+
+def _replace(src, dst):
+  '''Renames src to dst, replacing it.'''
+  try:
+    os.rename(src, dst)
+  except OSError: # filesystems that won't rename over an existing file
+    os.remove(dst)
+    os.rename(src, dst)
+
+
+def _fresh(fn):
+  '''Removes fn if it's there (so writing it can't truncate a file it's linked to), and returns it.'''
+  if _exists(fn):
+    os.remove(fn)
+  return fn
+
+
+def _copy(src, dst, block=None):
+  with open(src,'rb') as fin, _FlashWriter(dst, block) as fout:
+    fout.copy_from(fin)
 
 
 def _isdir(fn):
@@ -421,6 +2155,16 @@ def _exists(fn):
     return False
 
 
+def _remove_tree(directory):
+  for fn in os.listdir(directory):
+    fn = f'{directory}/{fn}'
+    if _isdir(fn):
+      _remove_tree(fn)
+    else:
+      os.remove(fn)
+  os.rmdir(directory)
+
+
 def _rmrf(directory):
   git_dir = f'{directory}/.ygit'
   if _isdir(git_dir):
@@ -430,7 +2174,7 @@ def _rmrf(directory):
     os.rmdir(git_dir)
 
 
-def clone(url, directory='.', *, username=None, password=None, ref='HEAD', shallow=True, cone=None, quiet=False):
+def clone(url, directory='.', *, username=None, password=None, ref='HEAD', shallow=True, cone=None, sparse=None, ephemeral=False, slots=False, quiet=False, events=None, workers=None, block_size=None):
   '''
     Clones a repository.
 
@@ -440,27 +2184,85 @@ def clone(url, directory='.', *, username=None, password=None, ref='HEAD', shall
     :param username: Username for HTTP authentication.
     :param password: Password or personally access token for HTTP authentication.  See: https://docs.github.com/en/authentication/keeping-your-account-and-data-secure/creating-a-personal-access-token
     :param cone: Only checkout files in this subdirectory, as if they were in the root directory.  Useful for if the code you want on your microcontroller is in a subdirectory of your repo.
+    :param sparse: Only checkout files matching these patterns.  Each is a (repo relative) file or directory path, or if prefixed by ``!`` a path to exclude.  The deepest matching pattern wins.  Ex: ``['lib/', '!lib/tests/', 'main.py']``
     :param shallow: Only download trees/blobs for specified revision (not all history). 
-    :param quiet: Passed to the git server.
+    :param ephemeral: Check files out as the pack arrives, w/o storing the pack or an object index.  Only the refs and a manifest of the checked out files are kept, roughly halving the flash needed.  Later pulls and checkouts download a full snapshot of the new commit (but only rewrite changed files).  Implies ``shallow``.
+    :param slots: Check out into two slots, ``a/`` and ``b/`` under directory.  Each checkout fills the inactive
+      slot (linking or copying unchanged files from the active one) and then switches to it w/ a single rename, so
+      a power loss mid-update leaves the previous version intact, and ``Repo.rollback()`` switches back instantly.
+      See ``Repo.work_dir()`` for the active one.
+    :param quiet: Passed to the git server, and silences local output.
+    :param events: An event sink (see ``NullEvents``) to receive progress.  Defaults to ``ConsoleEvents()``.
+    :param workers: See ``Repo``.
+    :param block_size: See ``Repo``.
 
   '''
   if isinstance(ref,str):
     ref = ref.encode()
-  print(f'cloning {url} into {directory} @ {ref.decode()}')
-  repo = Repo(directory)
-  repo._init(url, cone=cone, username=username, password=password)
+  repo = Repo(directory, events=events, workers=workers, block_size=block_size)
+  events = repo._events(quiet)
+  events.event(MESSAGE, f'cloning {url} into {directory} @ {ref.decode()}')
+  repo._init(url, cone=cone, sparse=sparse, ephemeral=ephemeral, slots=slots, username=username, password=password)
   try:
-    repo.pull(quiet=quiet, shallow=shallow, ref=ref, _decomp_kill=False)
+    with events.span('clone'):
+      repo.pull(quiet=quiet, shallow=shallow, ref=ref, _decomp_kill=False)
     return repo
   finally:
     DecompIO.kill()
 
 
+def fetch_many(repos, concurrency=4, **kwargs):
+  '''
+    Fetches several clones concurrently.  Identical requests to the same remote w/ the same credentials (the ref
+    advertisement, or a pack w/ the same wants and haves) are only made once, and the downloaded pack is hard linked (or copied)
+    into every repo that asked for it.  So updating many clones of one upstream costs about one fetch.
+
+    :param repos: A list of ``Repo`` objects or directories.
+    :param concurrency: The maximum number of fetches in flight at once.
+    :param kwargs: Passed to ``Repo.fetch_async()`` (ex: ``ref``, ``shallow``, ``quiet``).
+    :returns updated: A list of booleans, one per repo.
+  '''
+  return asyncio.run(fetch_many_async(repos, concurrency=concurrency, **kwargs))
+
+
+async def fetch_many_async(repos, concurrency=4, **kwargs):
+  '''
+    Like ``fetch_many()``, but as a coroutine.
+  '''
+  repos = [Repo(repo) if isinstance(repo, str) else repo for repo in repos]
+  sem = asyncio.Semaphore(concurrency)
+  shared = {}
+  async def fetch(repo):
+    async with sem:
+      return await repo.fetch_async(_shared=shared, **kwargs)
+  return await asyncio.gather(*[fetch(repo) for repo in repos])
+
+
 class Repo:
 
 
-  def __init__(self, directory='.'):
+  def __init__(self, directory='.', events=None, workers=None, block_size=None):
+    '''
+      :param workers: On CPython, index downloaded packs w/ this many processes.  For large packs on a
+        multi-core host; the index is the same as w/o.
+      :param block_size: Files are written in multiples of this.  Defaults to the filesystem's block size.
+    '''
     self._dir = directory
+    self.events = events or ConsoleEvents()
+    self._workers = workers
+    self._block = block_size
+    self._etags = {} # ref -> (ETag, sha) from the last check_for_updates()
+    self._trees = {} # a few recently read trees, for open() / ls()
+
+
+  def _events(self, quiet):
+    return _NULL_EVENTS if quiet else self.events
+
+
+  def _block_size(self):
+    if not self._block:
+      self._block = _block_size(f'{self._dir}/.')
+    return self._block
 
     
   @property
@@ -481,7 +2283,7 @@ class Repo:
   def _save_auth(self, db, username, password, url=None):
     if isinstance(url, str):
       url = url.encode()
-    c = cryptolib.aes(b'ygit'+binascii.hexlify(machine.unique_id()).decode(),1)
+    c = _platform.cipher()
     s = f'{username}:{password}'.encode()
     b64 = b'Basic '+binascii.b2a_base64(s)[:-1]
     if len(b64)%16:
@@ -492,8 +2294,18 @@ class Repo:
     db[b'Basic HTTP auth for '+url] = encrypted
     
     
-  def _git_upload_pack(self, url, data=None):
-    gc.collect()
+  def _auth_header(self, url):
+    '''The Authorization header stored for url, if any.'''
+    with DB(f'{self._git_dir}/config') as db:
+      auth = db.get(b'Basic HTTP auth for '+url.encode())
+    if auth:
+      return _platform.cipher().decrypt(auth).decode().strip()
+
+
+  async def _git_upload_pack(self, url, data=None, extra_headers=None):
+    if not url.startswith(('http://', 'https://')):
+      raise Exception(f'not an http(s) remote: {url} (a local repo cloned w/ python -m ygit can only be fetched w/ it)')
+    _memory.reserve(_WINDOW)
     proto, _, host, path = url.split("/", 3)
     port = 443 if proto=='https:' else 80
     if ':' in host:
@@ -501,108 +2313,400 @@ class Repo:
       port = int(port)
     method = 'POST' if data else 'GET'
     endpoint = 'git-upload-pack' if method=='POST' else 'info/refs?service=git-upload-pack'
-    s = socket.socket()
-    s.connect((host, port))
-    if proto=='https:':
-      s = ssl.wrap_socket(s)
-    x = s.makefile("rb") if hasattr(s,'makefile') else s
-    send = s.send if hasattr(s,'send') else s.write
-    req = f'{method} /{path}/{endpoint} HTTP/1.0\r\n'
-    send(req.encode())
+    x, w = await _platform.open_connection(host, port, proto=='https:')
+    w.write(f'{method} /{path}/{endpoint} HTTP/1.0\r\n'.encode())
     headers = {
       'Host': host,
       'User-Agent': 'ygit/0.0.1',
       'Accept': '*/*',
     }
-    with DB(f'{self._git_dir}/config') as db:
-      if b'Basic HTTP auth for '+url.encode() in db:
-        auth = db[b'Basic HTTP auth for '+url.encode()]
-        c = cryptolib.aes(b'ygit'+binascii.hexlify(machine.unique_id()).decode(),1)
-        headers['Authorization'] = c.decrypt(auth).decode().strip()
+    auth = self._auth_header(url)
+    if auth:
+      headers['Authorization'] = auth
     if data:
       headers['Content-Type'] = 'application/x-git-upload-pack-request'
       headers['Accept'] = 'application/x-git-upload-pack-result'
       headers['Accept-Encoding'] = 'deflate, gzip, br, zstd'
       headers['Git-Protocol'] = 'version=2'
       headers['Content-Length'] = str(len(data))
+    if extra_headers:
+      headers.update(extra_headers)
     for k,v in headers.items():
-      send(f'{k}: {v}\r\n'.encode())
+      w.write(f'{k}: {v}\r\n'.encode())
       #print('k,v', k,v)
-    send(b'\r\n')
+    w.write(b'\r\n')
     if data:
-      send(data)
-    return s,x
+      w.write(data)
+    await w.drain()
+    return _BufferedStream(x), w
 
 
-  def _init(self, repo, cone=None, username=None, password=None):
+  def _init(self, repo, cone=None, sparse=None, ephemeral=False, slots=False, username=None, password=None):
     git_dir = self._git_dir
     if _isdir(git_dir):
       raise Exception(f'fatal: ygit repo already exists at {git_dir}')
+    if ephemeral and slots:
+      raise Exception('ephemeral clones can\'t have slots')
     if not _isdir(self._dir):
       os.mkdir(self._dir)
     os.mkdir(git_dir)
     with DB(f'{git_dir}/config') as db:
       db[b'repo'] = repo.encode()
-      # currently only a str is supported, but a list of strings is eventually intended
       if cone:
         if not cone.endswith('/'): cone += '/'
         db[b'cone'] = json.dumps(cone)
+      if sparse:
+        db[b'sparse'] = json.dumps(list(sparse))
+      if ephemeral:
+        db[b'ephemeral'] = b'1'
+      if slots:
+        db[b'slots'] = b'1'
       if username and password:
         self._save_auth(db, username, password)
 
 
-  def checkout(self, ref='HEAD', _decomp_kill=True):
+  def checkout(self, ref='HEAD', quiet=False, _decomp_kill=True):
     '''
       Updates your files to the revision specified.
+
+      :param quiet: Silences local output.
     '''
+    return asyncio.run(self.checkout_async(ref=ref, quiet=quiet, _decomp_kill=_decomp_kill))
+
+
+  async def checkout_async(self, ref='HEAD', quiet=False, slice_ms=50, _decomp_kill=True):
+    '''
+      Like ``checkout()``, but yields to other asyncio tasks between files.
+
+      :param slice_ms: How long to run before yielding.
+    '''
+    events = self._events(quiet)
+    slicer = _Slicer(slice_ms)
     try:
       git_dir = self._git_dir
       commit = self._ref_to_commit(ref)
       if not commit:
         raise Exception(f'unknown ref: {ref}')
-      with DB(f'{self._git_dir}/config') as config:
-        cone = json.loads(config[b'cone']) if b'cone' in config else None
-      with DB(f'{git_dir}/idx') as db:
-        print('checking out', commit.decode())
-        commit = self._get_commit(db, commit)
-        for mode, fn, digest in self._walk_tree_files(git_dir, db, self._dir, commit.tree):
-          #print('entry', repr(mode), int(mode), fn, binascii.hexlify(digest) if digest else None, cone)
-          if cone:
-            repo_fn = fn[len(self._dir)+1:]
-            if repo_fn.startswith(cone):
-              fn = self._dir + '/' + repo_fn[len(cone):]
-            else:
-              continue
-          if int(mode)==40000:
-            if not _isdir(fn):
-              os.mkdir(fn)
-          elif int(mode)==160000:
-            print('ignoring submodule:', fn)
-          else:
-            self._checkout_file(git_dir, db, fn, digest)
-        self._remove_deleted_files(db, commit, cone)
+      if self._is_ephemeral():
+        with events.span('checkout'):
+          await self._stream_checkout(commit, quiet, events, slicer)
+        return
+      matcher = self._matcher()
+      with DB(f'{git_dir}/idx') as db, events.span('checkout'):
+        events.event(MESSAGE, f'checking out {commit.decode()}')
+        await self._autofetch(db, commit, slicer)
+        commit_obj = self._get_commit(db, commit)
+        if self._has_slots():
+          await self._checkout_slot(db, commit, commit_obj.tree, matcher, events, slicer)
+          return
+        old = self._manifest()
+        manifest = await self._checkout_tree(db, commit_obj.tree, matcher, old, self._dir, events, slicer)
+        if old.commit is None: # cloned before manifests were kept
+          self._remove_deleted_files(db, commit_obj, matcher)
+        _Manifest.write(old.fn, commit, manifest, self._block_size())
     finally:
       if _decomp_kill: DecompIO.kill()
+
+
+  async def _checkout_tree(self, db, tree, matcher, old, work_dir, events, slicer, old_dir=None):
+    '''
+      Checks tree out into work_dir, merge-joining it w/ the old manifest.  Returns the new manifest's entries.
+
+      :param old_dir: Where old's files are, if not in work_dir.  Unchanged files are linked from there.
+    '''
+    files = []
+    for mode, fn, digest in self._walk_checkout(db, tree, matcher, work_dir):
+      if mode==40000:
+        if not _isdir(fn):
+          os.mkdir(fn)
+      elif mode==160000:
+        events.event(MESSAGE, f'ignoring submodule: {fn}')
+      else:
+        files.append((fn[len(work_dir)+1:], mode, digest))
+    files.sort()
+    manifest = []
+    for old_entry, entry in _merge_join(old, files):
+      if not entry: # not in this commit
+        fn = f'{work_dir}/{old_entry[0]}'
+        if not old_dir and _exists(fn) and not _isdir(fn):
+          os.remove(fn)
+        continue
+      local, mode, digest = entry
+      fn = f'{work_dir}/{local}'
+      old_fn = f'{old_dir}/{local}' if old_dir else fn
+      if old_entry and old_entry[2]==digest and old.unchanged(old_fn, old_entry[3], old_entry[4]):
+        if old_dir:
+          _link(old_fn, fn, self._block_size())
+          manifest.append(entry + _stat(fn))
+        else:
+          manifest.append(old_entry)
+      else:
+        try:
+          self._checkout_file(self._git_dir, db, fn, digest, events=events)
+        except _MissingBase: # a delta against a checked out file that's changed since it was fetched
+          await self._fetch_objects(db, [digest], events, slicer)
+          self._checkout_file(self._git_dir, db, fn, digest, events=events)
+        manifest.append(entry + _stat(fn))
+      await slicer.tick()
+    return manifest
+
+
+  def _has_slots(self):
+    with DB(f'{self._git_dir}/config') as config:
+      return b'slots' in config
+
+
+  def _active_slot(self):
+    '''The checked out slot (``'a'`` or ``'b'``) of an A/B clone, or None.'''
+    try:
+      with open(f'{self._git_dir}/slot') as f:
+        return f.read().strip() or None
+    except OSError:
+      return None
+
+
+  def work_dir(self):
+    '''
+      Where files are checked out: the active slot of an A/B clone (see ``clone(slots=True)``), otherwise the
+      repo's directory.
+    '''
+    slot = self._active_slot()
+    return f'{self._dir}/{slot}' if slot else self._dir
+
+
+  async def _checkout_slot(self, db, commit, tree, matcher, events, slicer):
+    '''
+      Checks out into the inactive slot, linking (or copying) unchanged files from the active one, then makes it
+      the active one.  The slot being replaced has its manifest removed first, so it can't be rolled back to
+      half written.
+    '''
+    active = self._active_slot()
+    old = self._manifest(active)
+    if old.commit==commit:
+      events.event(MESSAGE, 'up to date!')
+      return
+    target = 'b' if active=='a' else 'a'
+    work_dir = f'{self._dir}/{target}'
+    fn = f'{self._git_dir}/manifest.{target}'
+    if _exists(fn): os.remove(fn)
+    if _isdir(work_dir): _remove_tree(work_dir)
+    os.mkdir(work_dir)
+    events.event(MESSAGE, f'checking out into slot {target}')
+    manifest = await self._checkout_tree(db, tree, matcher, old, work_dir, events, slicer, old_dir=f'{self._dir}/{active}' if active else None)
+    _Manifest.write(fn, commit, manifest, self._block_size())
+    self._switch_slot(target)
+
+
+  def _switch_slot(self, slot):
+    '''Makes slot the active one, w/ a single rename.'''
+    fn = f'{self._git_dir}/slot'
+    with open(fn+'.new', 'w') as f:
+      f.write(slot)
+    _replace(fn+'.new', fn)
+
+
+  def rollback(self):
+    '''
+      Switches an A/B clone (see ``clone(slots=True)``) back to what was checked out before its last checkout.
+      Nothing is fetched or written except the slot pointer.
+    '''
+    active = self._active_slot()
+    if not active:
+      raise Exception('rollback() needs an A/B clone (see slots in clone()) w/ something checked out')
+    previous = 'b' if active=='a' else 'a'
+    commit = self._manifest(previous).commit
+    if not commit:
+      raise Exception('no previous checkout to roll back to')
+    self._switch_slot(previous)
+    self.events.event(MESSAGE, f'rolled back to {commit.decode()}')
   
   
-  def _remove_deleted_files(self, db, commit, cone):
+  def _is_ephemeral(self):
+    with DB(f'{self._git_dir}/config') as config:
+      return b'ephemeral' in config
+
+
+  def _manifest(self, slot=None):
+    return _Manifest(f'{self._git_dir}/manifest.{slot}' if slot else f'{self._git_dir}/manifest')
+
+
+  async def _stream_checkout(self, commit, quiet, events, slicer):
+    old = self._manifest()
+    if old.commit==commit and all(old.unchanged(f'{self._dir}/{local}', size, mtime) for local, mode, sha, size, mtime in old):
+      events.event(MESSAGE, 'up to date!')
+      return
+    events.event(MESSAGE, f'checking out {commit.decode()} (ephemeral)')
+    with DB(f'{self._git_dir}/config') as config:
+      repo = config[b'repo'].decode()
+    sink = _StreamCheckout(self, commit, self._matcher(), old, events)
+    await self._stream_pack(repo, self._fetch_cmd([commit], quiet, True, ()), sink, events, slicer)
+    if sink.missing(): # deltas against blobs outside the checkout, which were dropped
+      events.event(MESSAGE, f'fetching {len(sink.missing())} blobs whose delta base was dropped')
+      sink.next_pack()
+      await self._stream_pack(repo, self._fetch_cmd(sink.missing(), quiet, False, ()), sink, events, slicer)
+    sink.finish()
+    _Manifest.write(old.fn, commit, ((local,)+entry for local, entry in sorted(sink.manifest.items())), self._block_size())
+
+
+  async def _stream_pack(self, repo, cmd, sink, events, slicer):
+    stream = _platform.pack_stream(sink, f'{self._git_dir}/spool')
+    x,w = await self._git_upload_pack(repo, data=cmd)
+    await _read_headers(x)
+    async for packline in _PktLines(x, f=stream, events=events, slicer=slicer):
+      pass # section headers, shallow-info, etc.
+    await _close(w)
+    stream.close()
+
+
+  def _matcher(self):
+    with DB(f'{self._git_dir}/config') as config:
+      cone = json.loads(config[b'cone']) if b'cone' in config else None
+      sparse = json.loads(config[b'sparse']) if b'sparse' in config else None
+    return _PathMatcher(cone, sparse)
+
+
+  def _walk_checkout(self, db, tree, matcher, work_dir=None):
+    '''
+      Like ``_walk_tree_files()``, but only what the matcher includes, w/ paths mapped to where they're checked out
+      (IE w/ any cone removed, under work_dir if given).
+    '''
+    cone = matcher.cone or ''
+    if work_dir is None: work_dir = self._dir
+    for mode, fn, digest in self._walk_tree_files(self._git_dir, db, self._dir, tree, prune=matcher.prune):
+      repo_fn = fn[len(self._dir)+1:]
+      if mode==40000:
+        if not repo_fn.startswith(cone): continue
+      elif not matcher.match(repo_fn):
+        continue
+      yield mode, work_dir + '/' + repo_fn[len(cone):], digest
+
+
+  def _remove_deleted_files(self, db, commit, matcher):
     if not commit.parents: return
     parent = self._get_commit(db, commit.parents[0].encode(), autofetch=False)
     if not parent: return
-    current_files = {}
-    for directory, files in self._walk_tree(self._git_dir, db, self._dir, commit.tree):
-      #print('cureent', directory, files)
-      current_files[directory] = set([e.fn for e in files])
-    for directory, files in self._walk_tree(self._git_dir, db, self._dir, parent.tree):
-      if cone and not directory[len(self._dir)+1:].startswith(cone.rstrip('/')): continue
-      current_dir = current_files.get(directory, set())
-      for entry in files:
-        if entry.fn not in current_dir:
-          full_fn = f'{directory[:-len(cone)]}/{entry.fn}' if cone else f'{directory}/{entry.fn}'
-          if _exists(full_fn) and not _isdir(full_fn):
-            os.remove(full_fn)
+    current_files = set()
+    for mode, fn, digest in self._walk_checkout(db, commit.tree, matcher):
+      current_files.add(fn)
+    for mode, fn, digest in self._walk_checkout(db, parent.tree, matcher):
+      if mode!=40000 and fn not in current_files and _exists(fn) and not _isdir(fn):
+        os.remove(fn)
   
   
+  def open(self, path, ref='HEAD'):
+    '''
+      Opens a file as of ref, w/o checking it out.  Returns a read-only, file-like stream (w/ ``read()``,
+      ``close()`` and a ``size``), readable as a context manager.  Only the trees along path are read.
+
+      :param path: A path in the repo, relative to its top (not the cone).  Ex: ``'lib/config.json'``
+    '''
+    mode, sig = self._lookup(path, ref)
+    if mode in (40000, 160000):
+      raise Exception(f'not a file: {path}')
+    with DB(f'{self._git_dir}/idx') as db:
+      source = self._object_finder(db)(sig)
+      if source is None:
+        raise Exception(f'unknown ref for file:{path} sig:{binascii.hexlify(sig)}')
+      return _BlobStream(source)
+
+
+  def ls(self, path='', ref='HEAD'):
+    '''
+      Lists a directory as of ref, w/o checking it out.  Directory names end with ``/``.
+
+      :param path: A path in the repo, relative to its top (not the cone).  Defaults to the top.
+    '''
+    mode, sig = self._lookup(path, ref)
+    if mode!=40000:
+      raise Exception(f'not a directory: {path}')
+    with DB(f'{self._git_dir}/idx') as db:
+      return [name+'/' if mode==40000 else name for mode, name, sig in self._cached_tree(db, sig)]
+
+
+  def archive(self, ref, out, cone=None, format='tar'):
+    '''
+      Writes a commit's files to out as a tar archive, w/o checking them out.  Directories come first, then files
+      in the order they're stored in the packs.  Every entry's mtime is the commit's.
+
+      :param ref: A branch, tag or commit (ex: ``'HEAD'``).
+      :param out: A binary file-like object.
+      :param cone: Only archive this subdirectory, as if it were the top level.
+      :param format: ``'tar'``, or ``'tar.gz'`` / ``'tgz'`` to gzip it.
+    '''
+    if format not in ('tar', 'tar.gz', 'tgz'):
+      raise Exception(f'unknown archive format: {format}')
+    commit = self._ref_to_commit(ref)
+    if not commit:
+      raise Exception(f'unknown ref: {ref}')
+    if cone and not cone.endswith('/'): cone += '/'
+    gz = _platform.gzip(out) if format!='tar' else None
+    with DB(f'{self._git_dir}/idx') as db:
+      commit = self._get_commit(db, commit)
+      tar = _TarWriter(gz or out, mtime=int(commit.committer.split()[-2]))
+      files = []
+      for mode, fn, digest in self._walk_checkout(db, commit.tree, _PathMatcher(cone), ''):
+        name = fn[1:]
+        if mode==40000:
+          if name: tar.add(name+'/', mode, kind=b'5')
+        elif mode==160000:
+          self.events.event(MESSAGE, f'ignoring submodule: {name}')
+        else:
+          if digest not in db:
+            raise Exception(f'unknown ref for file:{name} sig:{binascii.hexlify(digest)}')
+          pkt_id, kind, pos, size, ostart = struct.unpack('QBQQQ', db[digest])
+          files.append((pkt_id, ostart, size, name, mode, digest))
+      files.sort()
+      find = self._object_finder(db)
+      f, f_id = None, None
+      try:
+        for pkt_id, ostart, size, name, mode, digest in files:
+          if pkt_id!=f_id:
+            if f: f.close()
+            f, f_id = _platform.open_pack(f'{self._git_dir}/{pkt_id}.pack'), pkt_id
+          f.seek(ostart)
+          try:
+            obj = _ObjReader(f, find)
+          except _MissingBase: # a delta against a base since cleaned up, but the file may still be checked out
+            obj = find(digest)
+            if obj is None: raise
+          with obj as fin:
+            if mode==120000:
+              tar.add(name, mode, kind=b'2', link=fin.read(size).decode())
+            else:
+              tar.add(name, mode, size, fin)
+      finally:
+        if f: f.close()
+    tar.close()
+    if gz: gz.close()
+
+
+  def _lookup(self, path, ref):
+    '''Returns the (mode, binary sha) at path in ref's tree.'''
+    commit = self._ref_to_commit(ref)
+    if not commit:
+      raise Exception(f'unknown ref: {ref}')
+    with DB(f'{self._git_dir}/idx') as db:
+      mode, sig = 40000, binascii.unhexlify(self._get_commit(db, commit).tree)
+      for name in path.strip('/').split('/') if path.strip('/') else ():
+        if mode!=40000:
+          raise Exception(f'not a directory in {path}: {name}')
+        for mode, entry_name, entry_sig in self._cached_tree(db, sig):
+          if entry_name==name:
+            sig = entry_sig
+            break
+        else:
+          raise Exception(f'no such file at {ref}: {path}')
+    return mode, sig
+
+
+  def _cached_tree(self, db, sig):
+    if sig not in self._trees:
+      if len(self._trees) >= _buffer_size(8, fraction=8*1024, minimum=1):
+        self._trees.clear()
+      self._trees[sig] = self._read_tree(db, sig)
+    return self._trees[sig]
+
+
   def log(self, ref='HEAD', out=sys.stdout):
     '''
       Prints to stdout (or a file-like object, via the out parameter) the git log. 
@@ -623,7 +2727,7 @@ class Repo:
         sig = commit.parents[0].encode() if commit.parents else None
     if sig and not commit:
       out.write(f'Parent {sig.decode()} not available in this shallow clone.\n')
-      out.write(f'Run repo.fetch({repr(sig.decode())}, blobless=True) to retrieve more history.\n')
+      out.write(f'Run repo.fetch(deepen=1) to retrieve more history.\n')
       out.write(f'Add shallow=False to fetch all history.\n')
       
 
@@ -637,82 +2741,147 @@ class Repo:
     commit = self._ref_to_commit(ref)
     if not commit:
       raise Exception(f'unknown ref: {ref}')
+    manifest = self._manifest(self._active_slot())
+    if manifest.commit==commit or self._is_ephemeral():
+      return self._manifest_status(manifest, out)
+    work_dir = self.work_dir()
     with DB(f'{git_dir}/idx') as db:
-      print('status of', commit.decode())
+      self.events.event(MESSAGE, f'status of {commit.decode()}')
       commit = self._get_commit(db, commit)
-      for mode, fn, digest in self._walk_tree_files(git_dir, db, self._dir, commit.tree):
-        if int(mode)==40000:
+      for mode, fn, digest in self._walk_checkout(db, commit.tree, self._matcher(), work_dir):
+        if mode==40000:
           if not _isdir(fn):
             out.write(f'A {fn}\n')
             changes = True
+        elif mode==160000:
+          continue
         else:
           status = self._checkout_file(git_dir, db, fn, digest, write=False)
           if status:
-            out.write(f'{status} {fn[len(self._dir):]}\n')
+            out.write(f'{status} {fn[len(work_dir):]}\n')
             changes = True
     return changes
 
 
+  def _manifest_status(self, manifest, out):
+    '''Like ``status()`` for the checked out commit, only hashing files whose stat doesn't match the manifest's.'''
+    self.events.event(MESSAGE, f'status of {manifest.commit.decode()}')
+    changes = False
+    work_dir = self.work_dir()
+    for local, mode, sha, size, mtime in manifest:
+      fn = f'{work_dir}/{local}'
+      if not _exists(fn):
+        status = 'D'
+      elif manifest.unchanged(fn, size, mtime):
+        continue
+      elif _file_hash(fn)==sha:
+        continue
+      else:
+        status = 'M'
+      out.write(f'{status} /{local}\n')
+      changes = True
+    return changes
+
+
   def _build_cone_want_list(self, ref='HEAD'):
     want_list = [] # binary (not hex) digests
     git_dir = self._git_dir
     commit = self._ref_to_commit(ref)
     if not commit:
       raise Exception(f'unknown ref: {ref}')
-    with DB(f'{self._git_dir}/config') as db:
-      cone = json.loads(db[b'cone']) if b'cone' in db else None
+    matcher = self._matcher()
     with DB(f'{self._git_dir}/idx') as idx:
       commit = self._get_commit(idx, commit)
-      for mode, fn, digest in self._walk_tree_files(git_dir, idx, self._dir, commit.tree):
-        fn = fn[len(self._dir)+1:]
-        if digest and digest not in idx and fn.startswith(cone):
+      for mode, fn, digest in self._walk_checkout(idx, commit.tree, matcher):
+        if mode not in (40000, 160000) and digest not in idx:
           want_list.append(digest)
-        #print('fn, digest',fn, digest)
     return want_list
 
 
-  def _checkout_file(self, git_dir, db, fn, ref, write=True):
+  def _checkout_file(self, git_dir, db, fn, ref, write=True, events=_NULL_EVENTS):
     if ref not in db:
       raise Exception(f'unknown ref for file:{fn} sig:{binascii.hexlify(ref)}')
     ref_data = db[ref]
     pkt_id, kind, pos, size, ostart = struct.unpack('QBQQQ', ref_data)
-    assert kind in (3,6)
-    h = hashlib.sha1()
-    h.update(b'blob ')
-    h.update(str(size).encode())
-    h.update(b'\x00')
+    assert kind in (3,6,7)
     try:
-      with open(fn,'rb') as f:
-        while data:=f.read(1024):
-          h.update(data)
-      status = 'M' if h.digest()!=ref else None
-    except FileNotFoundError:
+      status = 'M' if _file_hash(fn)!=ref else None
+    except OSError:
       status = 'D'
     if status and write:
-      if kind==3: kind = 'BLOB'
-      if kind==6: kind = 'OFS_DELTA'
-      print('writing:', fn, f'({kind})')
       pkt_fn = f'{git_dir}/{pkt_id}.pack'
-      with open(pkt_fn, 'rb') as pkt_f:
+      events.event(FILE, (fn, {3:'BLOB', 6:'OFS_DELTA', 7:'REF_DELTA'}[kind]))
+      out_fn = fn if kind==3 else _fresh(fn+'.ygit-tmp') # a delta's base may be the file it replaces
+      with _platform.open_pack(pkt_fn) as pkt_f:
         pkt_f.seek(ostart)
-        with _ObjReader(pkt_f) as fin:
-          with open(fn, 'wb') as fout:
-            while data:=fin.read(128):
-              fout.write(data)
+        with _ObjReader(pkt_f, self._object_finder(db)) as fin:
+          with _FlashWriter(out_fn, self._block_size()) as fout:
+            fout.copy_from(fin)
+      if out_fn!=fn: _replace(out_fn, fn)
     return status
 
 
+  def _object_finder(self, db):
+    '''
+      Returns find(sha), which gives an ``_ObjectSource`` for the object w/ that sha, or None.  It's read from
+      the packs if it's in the index (and its delta chain resolves), or else from a checked out file that still
+      holds it.  So the REF_DELTAs of a thin pack resolve against the working tree, even after ``cleanup()``.
+    '''
+    git_dir = self._git_dir
+    files = {} # sha -> a checked out file holding it, or None
+    def find(sha):
+      idx = db.get(sha)
+      if idx:
+        pkt_id, kind, pos, size, ostart = struct.unpack('QBQQQ', idx)
+        fn = f'{git_dir}/{pkt_id}.pack'
+        base = None
+        if kind in (6,7):
+          with _platform.open_pack(fn) as f:
+            base = _ref_base(f, ostart)
+        if base is None or find(base):
+          return _ObjectSource(kind if kind<6 else None, size, fn, ostart, find)
+      if sha not in files:
+        files[sha] = self._checked_out(sha)
+      return files[sha] and _ObjectSource(3, _stat(files[sha])[0], files[sha])
+    return find
+
+
+  def _checked_out(self, sha):
+    '''
+      A checked out file holding the blob w/ that sha, or None.  Looked for in the manifest, and trusted if its
+      stat still matches it or else if it still hashes to sha.
+    '''
+    manifest = self._manifest(self._active_slot())
+    work_dir = self.work_dir()
+    for local, mode, digest, size, mtime in manifest:
+      if digest!=sha: continue
+      fn = f'{work_dir}/{local}'
+      try:
+        if manifest.unchanged(fn, size, mtime) or _file_hash(fn)==sha:
+          return fn
+      except OSError:
+        pass
+    return None
+
+
+  async def _autofetch(self, db, commit, slicer):
+    if commit and binascii.unhexlify(commit) not in db:
+      await self._fetch(self._git_dir, db, True, False, [commit], slicer=slicer)
+
+
   def _get_commit(self, db, commit, autofetch=True):
     if not commit: return None
     if autofetch and binascii.unhexlify(commit) not in db:
-      self._fetch(self._git_dir, db, True, False, commit)
+      if _in_event_loop(): # async callers fetch w/ _autofetch() first
+        raise Exception(f'commit {commit.decode()} is not local, and can\'t be fetched from inside a running event loop.  Use fetch_async() first.')
+      asyncio.run(self._fetch(self._git_dir, db, True, False, [commit]))
     idx = db.get(binascii.unhexlify(commit))
     if not idx and not autofetch: return None
     if not idx: raise Exception(f'Could not find {commit.decode()} ever after fetch.  This is eiter a bug in ygit or a corrupted git repository.  Please open an issue here: https://github.com/keredson/ygit/issues/new')
     pkt_id, kind, pos, size, ostart = struct.unpack('QBQQQ', idx)
     assert kind==1
     fn = f'{self._git_dir}/{pkt_id}.pack'
-    with open(fn, 'rb') as f:
+    with _platform.open_pack(fn) as f:
       f.seek(pos)
       s1 = DecompIO(f)
       tree, parents, author, committer = None, [], None, None
@@ -729,77 +2898,179 @@ class Repo:
     return _Commit(tree, parents, author, committer, message.getvalue().decode())
 
   
-  def _walk_tree(self, git_dir, db, directory, ref):
-    if isinstance(ref, str):
-      ref = binascii.unhexlify(ref)
-    data = db[ref]
-    pkt_id, kind, pos, size, ostart = struct.unpack('QBQQQ', data)
-    #print('pkt_id, kind, pos, size, ostart', pkt_id, kind, pos, size, ostart)
-    fn = f'{git_dir}/{pkt_id}.pack'
-    with open(fn, 'rb') as f:
-      f.seek(ostart)
-      o = _ObjReader(f)
-      assert o.get_real_kind()==2
-      next = []
-      with o as s2:
-        to_yield = []
-        while line:=_read_until(s2, b'\x00'):
-          digest = s2.read(20)
-          mode, fn = line[:-1].decode().split(' ',1)
-          if mode=='40000':
-            to_yield.append(_Entry(mode, fn, None))
-            next.append((fn, digest))
-          elif mode=='160000':
-            print('ignoring submodule', fn,'(unsupported)')
-          else:
-            to_yield.append(_Entry(mode, fn, digest))
-      yield directory, to_yield
-      for fn, digest in next:
-        yield from self._walk_tree(git_dir, db, f'{directory}/{fn}', digest)
+  def _read_tree(self, db, sig):
+    if isinstance(sig, str):
+      sig = binascii.unhexlify(sig)
+    pkt_id, kind, pos, size, ostart = struct.unpack('QBQQQ', db[sig])
+    with _platform.open_pack(f'{self._git_dir}/{pkt_id}.pack') as f:
+      kind, data = _read_object(f, ostart, self._object_finder(db))
+    assert kind==2
+    return _parse_tree(data)
 
 
-  def _walk_tree_files(self, git_dir, db, directory, ref):
-    for d, files in self._walk_tree(git_dir, db, directory, ref):
-      yield ('40000', f'{d}', None)
-      yield from [(entry.mode, f'{d}/{entry.fn}', entry.sig) for entry in files]
+  def _walk_tree(self, git_dir, db, directory, ref, prune=None):
+    '''
+      Yields (directory, [(mode, name, sig), ...]) for a tree and then its subtrees, depth first.  If given,
+      ``prune(path)`` is called w/ each subtree's repo relative path, and subtrees it returns True for aren't
+      read at all.  Submodules (mode 160000) are included, callers skip them.
+    '''
+    todo = [(directory, '', ref)]
+    while todo:
+      directory, path, ref = todo.pop()
+      entries = self._read_tree(db, ref)
+      yield directory, entries
+      for mode, name, sig in reversed(entries):
+        if mode==40000:
+          sub_path = f'{path}/{name}' if path else name
+          if not (prune and prune(sub_path)):
+            todo.append((f'{directory}/{name}', sub_path, sig))
+      del entries
+
+
+  def _walk_tree_files(self, git_dir, db, directory, ref, prune=None):
+    for d, files in self._walk_tree(git_dir, db, directory, ref, prune=prune):
+      yield (40000, d, None)
+      for mode, name, sig in files:
+        if mode!=40000: # yielded above when (if) walked
+          yield (mode, f'{d}/{name}', sig)
 
 
   def pull(self, shallow=True, quiet=False, ref='HEAD', _decomp_kill=True):
     '''
       Performs a fetch(), and if new changes are found, a checkout().
     '''
+    return asyncio.run(self.pull_async(shallow=shallow, quiet=quiet, ref=ref, _decomp_kill=_decomp_kill))
+
+
+  async def pull_async(self, shallow=True, quiet=False, ref='HEAD', slice_ms=50, _decomp_kill=True):
+    '''
+      Like ``pull()``, but yields to other asyncio tasks between pkt-lines, objects and files.
+
+      :param slice_ms: How long to run before yielding.
+    '''
     try:
-      if self.fetch(quiet=quiet, shallow=shallow, ref=ref, _decomp_kill=_decomp_kill):
-        self.checkout(ref=ref, _decomp_kill=_decomp_kill)
+      if await self.fetch_async(quiet=quiet, shallow=shallow, ref=ref, slice_ms=slice_ms, _decomp_kill=_decomp_kill):
+        await self.checkout_async(ref=ref, quiet=quiet, slice_ms=slice_ms, _decomp_kill=_decomp_kill)
     finally:
       if _decomp_kill: DecompIO.kill()
 
 
+  def check_for_updates(self, ref='HEAD'):
+    '''
+      Cheaply checks if the server has moved ref on since it was last fetched.  Only that ref is requested (w/
+      protocol v2's ``ls-refs``), and nothing is written locally.  If the server (or a caching proxy in front
+      of it) sent an ETag last time, it's sent back as ``If-None-Match``, and a ``304 Not Modified`` ends the
+      check early.
+
+      :returns: True if a ``pull()`` would find something new.
+    '''
+    return asyncio.run(self.check_for_updates_async(ref=ref))
+
+
+  async def check_for_updates_async(self, ref='HEAD'):
+    '''
+      Like ``check_for_updates()``, but as a coroutine.
+    '''
+    if isinstance(ref,str):
+      ref = ref.encode()
+    if len(ref)==40: return False # commits don't move
+    with DB(f'{self._git_dir}/config') as db:
+      repo = db[b'repo'].decode()
+    possible_refs = [ref, b'refs/heads/'+ref, b'refs/tags/'+ref, b'refs/pull/'+ref]
+    cmd = io.BytesIO()
+    cmd.write(_pkt_line(b'command=ls-refs\n'))
+    cmd.write(_pkt_line(b'object-format=sha1\n'))
+    cmd.write(b'0001')
+    for possible_ref in possible_refs:
+      cmd.write(_pkt_line(b'ref-prefix '+possible_ref+b'\n'))
+    cmd.write(b'0000')
+    etag, sha = self._etags.get(ref, (None, None))
+    x,w = await self._git_upload_pack(repo, data=cmd.getvalue(), extra_headers={'If-None-Match':etag} if etag else None)
+    headers = {}
+    try:
+      if await _read_headers(x, headers, ok=(200,304))==200:
+        found = {}
+        async for packline in _PktLines(x):
+          asha, aref = packline.strip().split(b' ', 2)[:2]
+          if aref in possible_refs:
+            found[aref] = asha
+        sha = None
+        for possible_ref in possible_refs:
+          if possible_ref in found:
+            sha = found[possible_ref]
+            break
+        if 'etag' in headers:
+          self._etags[ref] = (headers['etag'], sha)
+    finally:
+      await _close(w)
+    return sha is not None and sha!=self._ref_to_commit(ref)
+
+
+  def watch(self, ref='HEAD', interval=300, max_interval=3600, jitter=0.1, polls=None, quiet=False):
+    '''
+      Polls the server w/ ``check_for_updates()``, pulling whenever ref moves.  Each wait is randomly
+      lengthened or shortened by up to jitter (a fraction), so a fleet of devices doesn't poll in lockstep.
+      When a poll fails (ex: the network is down), the wait doubles, up to max_interval.
+
+      :param interval: Seconds between polls.
+      :param polls: Stop after this many polls.  Forever if None.
+    '''
+    return asyncio.run(self.watch_async(ref=ref, interval=interval, max_interval=max_interval, jitter=jitter, polls=polls, quiet=quiet))
+
+
+  async def watch_async(self, ref='HEAD', interval=300, max_interval=3600, jitter=0.1, polls=None, quiet=False):
+    '''
+      Like ``watch()``, but as a coroutine, so other tasks keep running between (and during) polls.
+    '''
+    wait = interval
+    while polls is None or polls > 0:
+      try:
+        if await self.check_for_updates_async(ref=ref):
+          await self.pull_async(ref=ref, quiet=quiet)
+        wait = interval
+      except Exception as e:
+        self.events.event(MESSAGE, f'poll failed: {e}')
+        wait = min(wait*2, max_interval)
+      if polls is not None:
+        polls -= 1
+        if not polls: break
+      await asyncio.sleep(wait * (1 + jitter*(random.getrandbits(16)/32768 - 1)))
+
+
+  def _refs(self):
+    '''Yields (ref, binary sha) for every known ref.'''
+    try:
+      f = open(f'{self._git_dir}/packed-refs', 'rb')
+    except OSError: # not fetched since refs moved out of the refs DB
+      if _exists(f'{self._git_dir}/refs'):
+        with DB(f'{self._git_dir}/refs') as db:
+          yield from db.items()
+      return
+    with f:
+      while line := f.readline():
+        sha, ref = line.rstrip(b'\n').split(b' ', 1)
+        yield ref, binascii.unhexlify(sha)
+
+
   def branches(self):
     '''
       Returns a list of known branches.
     '''
-    git_dir = self._git_dir
-    with DB(f'{git_dir}/refs') as db:
-      return [k[len(b'refs/heads/'):].decode() for k in db if k.startswith(b'refs/heads/')]
+    return [k[len(b'refs/heads/'):].decode() for k, sha in self._refs() if k.startswith(b'refs/heads/')]
   
 
   def tags(self):
     '''
       Returns a list of known tags.
     '''
-    git_dir = self._git_dir
-    with DB(f'{git_dir}/refs') as db:
-      return [k[len(b'refs/tags/'):].decode() for k in db if k.startswith(b'refs/tags/')]
+    return [k[len(b'refs/tags/'):].decode() for k, sha in self._refs() if k.startswith(b'refs/tags/')]
 
     
   def pulls(self):
     '''
       Returns a list of known pulls.
     '''
-    git_dir = self._git_dir
-    with DB(f'{git_dir}/refs') as db:
-      return [k[len(b'refs/pull/'):].decode() for k in db if k.startswith(b'refs/pull/')]
+    return [k[len(b'refs/pull/'):].decode() for k, sha in self._refs() if k.startswith(b'refs/pull/')]
   
 
   def _ref_to_commit(self, ref):
@@ -807,48 +3078,69 @@ class Repo:
       ref = ref.encode()
     if len(ref)==40:
       return ref
-    with DB(f'{self._git_dir}/refs') as db:
-      for possible_ref in [ref, b'refs/heads/'+ref, b'refs/tags/'+ref, b'refs/pull/'+ref]:
-        if possible_ref in db:
-         return binascii.hexlify(db[possible_ref])
+    possible_refs = [ref, b'refs/heads/'+ref, b'refs/tags/'+ref, b'refs/pull/'+ref]
+    found = {}
+    for k, sha in self._refs():
+      if k in possible_refs:
+        found[k] = sha
+    for possible_ref in possible_refs:
+      if possible_ref in found:
+        return binascii.hexlify(found[possible_ref])
     return None
 
   
-  def fetch(self, shallow=True, quiet=False, ref='HEAD', blobless=None, _decomp_kill=True):
+  def fetch(self, shallow=True, quiet=False, ref='HEAD', blobless=None, refs=None, deepen=None, _decomp_kill=True):
     '''
       Incrementally pulls new objects from the upstream repo.
 
       :param shallow: Only download trees/blobs for specified revision (not all history). 
-      :param quiet: Passed to the git server.
+      :param quiet: Passed to the git server, and silences local output.
       :param ref: The revision to fetch if shallow.
       :param blobless: Only pull commits/trees, not blobs.  (IE download the filesystem structure, not the files themselves.)
+      :param refs: Several revisions to fetch (instead of ref), all in one request and one pack.  Ex: ``['main', 'v1.2']``
+      :param deepen: Fetch this many more commits of history behind the current shallow boundary.
       :returns updated: If updates were found. 
     '''
+    return asyncio.run(self.fetch_async(shallow=shallow, quiet=quiet, ref=ref, blobless=blobless, refs=refs, deepen=deepen, _decomp_kill=_decomp_kill))
+
+
+  async def fetch_async(self, shallow=True, quiet=False, ref='HEAD', blobless=None, refs=None, deepen=None, slice_ms=50, _decomp_kill=True, _shared=None):
+    '''
+      Like ``fetch()``, but yields to other asyncio tasks between pkt-lines and objects.
+
+      :param slice_ms: How long to run before yielding.
+    '''
+    events = self._events(quiet)
+    slicer = _Slicer(slice_ms)
     try:
       directory = self._dir
-      if isinstance(ref,str):
-        ref = ref.encode()
+      wanted = [r.encode() if isinstance(r,str) else r for r in (refs or [ref])]
       git_dir = f'{directory}/.ygit'
       with DB(f'{git_dir}/config') as db:
         repo = db[b'repo'].decode()
-        cone = json.loads(db[b'cone']) if b'cone' in db else None
-      print(f'fetching: {repo} @ {ref.decode()}')
-
-      s,x = self._git_upload_pack(repo)
-      _read_headers(x)
-      capabilities = None
-      with DB(f'{git_dir}/refs') as db:
-        for packline in _iter_pkt_lines(x):
-          if packline.startswith(b'#'): continue
-          if b'\x00' in packline:
-            packline, capabilities = packline.split(b'\x00', 1)
-          arev, aref = packline.split(b' ', 1)
-          aref = aref.strip()
-          db[aref] =binascii.unhexlify(arev)
-        HEAD = binascii.hexlify(db[b'HEAD']) if b'HEAD' in db else None # empty repo
-      s.close()
-      
-      commit = self._ref_to_commit(ref)
+        ephemeral = b'ephemeral' in db
+      matcher = self._matcher()
+      events.event(MESSAGE, f'fetching: {repo} @ {b", ".join(wanted).decode()}')
+
+      with _PackedRefs(f'{git_dir}/packed-refs') as packed_refs, events.span('refs'):
+        if _shared is None:
+          await self._ls_remote(repo, slicer, packed_refs.add)
+        else:
+          for aref, rev in await _dedupe(_shared, ('refs', repo, self._auth_header(repo)), self._ls_remote, repo, slicer):
+            packed_refs.add(aref, rev)
+      if packed_refs.changed and _exists(f'{git_dir}/refs'):
+        os.remove(f'{git_dir}/refs') # replaced by packed-refs
+
+      commits = []
+      for r in wanted:
+        commit = self._ref_to_commit(r)
+        if refs and not commit:
+          raise Exception(f'unknown ref: {r.decode()}')
+        if commit and commit not in commits:
+          commits.append(commit)
+      if ephemeral: # objects are only fetched (streamed) at checkout
+        head = self._manifest().commit
+        return any(commit!=head for commit in commits)
 
     #  if requested_rev==b'HEAD':
     #    s,x = _request(repo, data=b'0014command=ls-refs\n0014agent=git/2.37.20016object-format=sha100010009peel\n000csymrefs\n000bunborn\n0014ref-prefix HEAD\n001bref-prefix refs/heads/\n0000')
@@ -859,78 +3151,174 @@ class Repo:
 
       with DB(f'{git_dir}/idx') as db:
         if blobless is None:
-          blobless = bool(cone)
-        ret = self._fetch(git_dir, db, shallow, quiet, commit, blobless=blobless)
-        if False and cone:
+          blobless = matcher.restricted
+        ret = await self._fetch(git_dir, db, shallow, quiet, commits, blobless=blobless, deepen=deepen, slicer=slicer, _shared=_shared)
+        if False and matcher.restricted:
           want_list = self._build_cone_want_list(ref=commit)
           #print('want_list',want_list)
           if want_list:
-            self._fetch(git_dir, db, shallow, quiet, commit, want_list=want_list)
+            await self._fetch(git_dir, db, shallow, quiet, commit, want_list=want_list, slicer=slicer)
 
       return ret
     finally:
       if _decomp_kill: DecompIO.kill()
 
 
-  def _fetch(self, git_dir, db, shallow, quiet, commit, blobless=False):
-    assert commit is None or isinstance(commit, bytes) and len(commit)==40 # only full hashes here
+  async def _ls_remote(self, url, slicer, on_ref=None):
+    '''Reads the server's ref advertisement, passing each to on_ref(ref, binary_sig) (or returning them as a list).'''
+    refs = [] if on_ref is None else None
+    x,w = await self._git_upload_pack(url)
+    await _read_headers(x)
+    async for packline in _PktLines(x, slicer=slicer):
+      if packline.startswith(b'#'): continue
+      if b'\x00' in packline:
+        packline, capabilities = packline.split(b'\x00', 1)
+      arev, aref = packline.split(b' ', 1)
+      if refs is None:
+        on_ref(aref.strip(), binascii.unhexlify(arev))
+      else:
+        refs.append((aref.strip(), binascii.unhexlify(arev)))
+    await _close(w)
+    return refs
+
+
+  async def _download_pack(self, url, data, fn, events, slicer):
+    '''Downloads a pack to fn.  Returns fn and the shallow-info section's ``shallow`` / ``unshallow`` lines.'''
+    x,w = await self._git_upload_pack(url, data=data)
+    await _read_headers(x)
+    shallow_info = []
+    tmp = _fresh(fn+'.tmp')
+    with _FlashWriter(tmp, self._block_size()) as f:
+      async for packline in _PktLines(x, f=f, events=events, slicer=slicer):
+        if packline.startswith(b'shallow ') or packline.startswith(b'unshallow '):
+          shallow_info.append(packline.strip())
+        # otherwise section headers, acknowledgments, etc.
+    await _close(w)
+    _replace(tmp, fn) # never truncating fn, which may be hard linked into other clones (see fetch_many())
+    return fn, shallow_info
+
+
+  def _shallow(self):
+    '''The (hex) commits whose parents this clone doesn't have.  Like git's .git/shallow.'''
+    try:
+      with open(f'{self._git_dir}/shallow','rb') as f:
+        return [line.strip() for line in f.read().splitlines() if line.strip()]
+    except OSError:
+      return []
+
+
+  def _update_shallow(self, shallow_info):
+    shallow = set(self._shallow())
+    before = set(shallow)
+    for line in shallow_info:
+      kind, commit = line.split(b' ', 1)
+      if kind==b'shallow':
+        shallow.add(commit)
+      else:
+        shallow.discard(commit)
+    if shallow!=before:
+      with open(f'{self._git_dir}/shallow','wb') as f:
+        for commit in sorted(shallow):
+          f.write(commit + b'\n')
+
+
+  async def _fetch(self, git_dir, db, shallow, quiet, commits, blobless=False, deepen=None, slicer=None, _shared=None):
+    commits = [commit for commit in commits if commit]
+    assert all(isinstance(commit, bytes) and len(commit)==40 for commit in commits) # only full hashes here
 
     with DB(f'{git_dir}/config') as config_db:
       repo = config_db[b'repo'].decode()
+    events = self._events(quiet)
 
-    if commit:
-      print(f'fetching commit: {commit.decode()}')
+    if commits:
+      events.event(MESSAGE, f'fetching commit: {b", ".join(commits).decode()}')
     else:
-      print('fetched an empty repo')
+      events.event(MESSAGE, 'fetched an empty repo')
       return False
 
-    if binascii.unhexlify(commit) in db:
-      print('up to date!')
-      return False
+    if not deepen:
+      commits = [commit for commit in commits if binascii.unhexlify(commit) not in db]
+      if not commits:
+        events.event(MESSAGE, 'up to date!')
+        return False
+
+    haves, shallows = [k for k in db.keys() if k!=b'HEAD'], self._shallow()
+    cmd = self._fetch_cmd(commits, quiet, shallow, haves, blobless=blobless, shallows=shallows, deepen=deepen, thin=True)
+    if await self._fetch_pack(git_dir, db, repo, cmd, events, slicer, _shared):
+      # deltas against blobs we've since cleaned up, and whose checked out files have changed
+      events.event(MESSAGE, 'some delta bases have changed, fetching again w/o a thin pack')
+      cmd = self._fetch_cmd(commits, quiet, shallow, haves, blobless=blobless, shallows=shallows, deepen=deepen)
+      if await self._fetch_pack(git_dir, db, repo, cmd, events, slicer, _shared):
+        raise Exception('the server sent deltas against objects we don\'t have')
+    return True
+
+  async def _fetch_objects(self, db, shas, events, slicer=None):
+    '''Fetches objects by sha, whole (ie: w/o haves, so none come as deltas against what we have).'''
+    with DB(f'{self._git_dir}/config') as config_db:
+      repo = config_db[b'repo'].decode()
+    cmd = self._fetch_cmd([binascii.hexlify(sha) for sha in shas], True, False, ())
+    await self._fetch_pack(self._git_dir, db, repo, cmd, events, slicer)
 
+  async def _fetch_pack(self, git_dir, db, repo, cmd, events, slicer, _shared=None):
+    '''Downloads the pack cmd asks for into the next pack file, and indexes it.  Returns how many deltas it couldn't.'''
+    db.flush()
+    i = max([int(s.split('.')[0]) for s in os.listdir(git_dir) if s.endswith('.pack')], default=0)+1
+    fn = f'{git_dir}/{i}.pack'
+    with events.span('download'):
+      key = ('pack', repo, self._auth_header(repo), cmd)
+      downloaded, shallow_info = await _dedupe(_shared, key, self._download_pack, repo, cmd, fn, events, slicer)
+      if downloaded!=fn:
+        tmp = _fresh(fn+'.tmp')
+        _link(downloaded, tmp)
+        _replace(tmp, fn)
+    self._update_shallow(shallow_info)
+    with events.span('index'):
+      return await _parse_pkt_file(git_dir, fn, i, db, events=events, slicer=slicer, workers=self._workers, find=self._object_finder(db))
+
+  def _fetch_cmd(self, commits, quiet, shallow, haves, blobless=False, shallows=(), deepen=None, thin=False):
+    '''
+      :param shallows: Commits we only have shallow copies of, so the server knows where our history stops.
+      :param deepen: If given, ask for this many more commits behind the current shallow boundary.
+      :param thin: Ask for a thin pack, whose deltas can be against objects we have (REF_DELTAs).
+    '''
     # https://git-scm.com/docs/protocol-v2
     cmd = io.BytesIO()
     cmd.write(b'0011command=fetch0014agent=git/2.37.20016object-format=sha10001000dofs-delta')
+    if thin and haves: cmd.write(b'000dthin-pack')
     if quiet: cmd.write(b'000fno-progress')
     if quiet: cmd.write(b'000finclude-tag')
-    if shallow: cmd.write(b'000cdeepen 1')
+    for commit in shallows:
+      cmd.write(_pkt_line(b'shallow '+commit+b'\n'))
+    if deepen:
+      cmd.write(_pkt_line(f'deepen {deepen}\n'.encode()))
+      cmd.write(_pkt_line(b'deepen-relative\n'))
+    elif shallow: cmd.write(b'000cdeepen 1')
+    elif shallows: cmd.write(_pkt_line(b'deepen 2147483647\n')) # unshallow
     if False and blobless: cmd.write(b'0014filter blob:none') # blobless clone
-    cmd.write(f'0032want {commit.decode()}\n'.encode())
-    for k in db.keys():
-      if k==b'HEAD': continue
+    for commit in commits:
+      cmd.write(f'0032want {commit.decode()}\n'.encode())
+    for k in haves:
       have = f'0032have {binascii.hexlify(k).decode()}\n'
-      print(repr(have))
       cmd.write(have.encode())
     cmd.write(b'0009done\n0000')
-    s,x = self._git_upload_pack(repo, data=cmd.getvalue())
-    _read_headers(x)
-    db.flush()
+    return cmd.getvalue()
 
-    i = len([s for s in os.listdir(git_dir) if s.endswith('.pack')])+1
-    fn = f'{git_dir}/{i}.pack'
-    with open(fn,'wb') as f:
-      for packline in _iter_pkt_lines(x, f=f):
-        if packline.startswith(b'\x02'):
-          print(packline[1:].decode().strip())
-        if packline.startswith(b'\x03'):
-          raise Exception(packline[1:].decode().strip())
-    _parse_pkt_file(git_dir, fn, i, db)
-
-    s.close()
-    return True
 
   def cleanup(self, keep_latest=True):
     '''
-    Cleans up the repository by removing older file blobs and unused OFS_DELTAs.
+    Cleans up the repository by removing older file blobs and unused OFS_DELTAs and REF_DELTAs.
     
     :param keep_latest: If True, keeps the latest version of each file.
     '''
     git_dir = self._git_dir
+    if self._is_ephemeral():
+        self.events.event(MESSAGE, "Ephemeral clones keep no objects.  Nothing to clean up.")
+        return
     with DB(f'{git_dir}/idx') as db:
         # Get the latest commit
         latest_commit = self._ref_to_commit('HEAD')
         if not latest_commit:
-            print("No commits found. Nothing to clean up.")
+            self.events.event(MESSAGE, "No commits found. Nothing to clean up.")
             return
 
         # Get all objects in the latest commit
@@ -939,23 +3327,23 @@ class Repo:
             latest_commit_obj = self._get_commit(db, latest_commit)
             self._collect_used_objects(db, latest_commit_obj.tree, used_objects)
 
-        # Iterate through all objects and remove old blobs and unused OFS_DELTAs
+        # Iterate through all objects and remove old blobs and unused deltas
         removed_count = 0
         for key in list(db.keys()):
             if len(key) == 20:  # SHA-1 hash length
                 idx = db[key]
                 pkt_id, kind, _, _, _ = struct.unpack('QBQQQ', idx)
-                if kind in (3, 6):  # Blob or OFS_DELTA
+                if kind in (3, 6, 7):  # Blob, OFS_DELTA or REF_DELTA
                     if not keep_latest or key not in used_objects:
                         del db[key]
                         removed_count += 1
 
-        print(f"Removed {removed_count} old blob and OFS_DELTA objects.")
+        self.events.event(MESSAGE, f"Removed {removed_count} old blob and delta objects.")
 
     # Remove unused pack files
     self._remove_unused_pack_files(git_dir, db)
 
-    print("Cleanup completed.")
+    self.events.event(MESSAGE, "Cleanup completed.")
 
   def _collect_used_objects(self, db, tree_hash, used_objects):
     '''Helper method to recursively collect all objects used in a tree.'''
@@ -963,20 +3351,11 @@ class Repo:
         return
     used_objects.add(tree_hash)
     
-    tree_data = db[binascii.unhexlify(tree_hash)]
-    pkt_id, kind, pos, size, ostart = struct.unpack('QBQQQ', tree_data)
-    fn = f'{self._git_dir}/{pkt_id}.pack'
-    with open(fn, 'rb') as f:
-        f.seek(ostart)
-        o = _ObjReader(f)
-        with o as s2:
-            while line := _read_until(s2, b'\x00'):
-                digest = s2.read(20)
-                mode, _ = line[:-1].decode().split(' ', 1)
-                if mode != '40000':  # Not a directory
-                    used_objects.add(digest)
-                else:
-                    self._collect_used_objects(db, binascii.hexlify(digest), used_objects)
+    for mode, name, digest in self._read_tree(db, tree_hash):
+        if mode != 40000:  # Not a directory
+            used_objects.add(digest)
+        else:
+            self._collect_used_objects(db, binascii.hexlify(digest), used_objects)
 
   def _remove_unused_pack_files(self, git_dir, db):
     '''Helper method to remove unused pack files.'''
@@ -990,7 +3369,251 @@ class Repo:
             pack_id = int(file.split('.')[0])
             if pack_id not in used_packs:
                 os.remove(f'{git_dir}/{file}')
-                print(f"Removed unused pack file: {file}")
+                self.events.event(MESSAGE, f"Removed unused pack file: {file}")
+
+
+
+
 
+class _Stats:
+  '''
+    Counters for the CLI's ``--stats``: zlib streams inflated, and bytes read and seeks on memory mapped packs.
+    Installed by wrapping what does the work, so they cost nothing otherwise.
+  '''
+
+  def __init__(self):
+    self.inflated = 0
+    self.read = 0
+    self.seeks = 0
+
+  def install(self):
+    '''Wraps the methods it counts.  Call ``uninstall()`` to put the originals back.'''
+    stats = self
+    self._originals = [(cls, name, cls.__dict__[name]) for cls, name in (
+      (DecompIO, '_reset_decompressor'), (_ZlibReader, 'read'), (_MappedPack, 'read'), (_MappedPack, 'seek'), (_MappedPack, 'inflate'))]
+    reset, zlib_read, read, seek, inflate = [fn for cls, name, fn in self._originals]
+    def counting_reset(s):
+      stats.inflated += 1
+      reset(s)
+    def consumed(r): # what zlib has used, not the windows handed to it
+      return r._pos - len(r._d.unconsumed_tail) - len(r._d.unused_data)
+    def counting_zlib_read(r, nbytes):
+      pos = consumed(r)
+      ret = zlib_read(r, nbytes)
+      stats.read += consumed(r) - pos
+      return ret
+    def counting_read(f, nbytes):
+      ret = read(f, nbytes)
+      stats.read += len(ret)
+      return ret
+    def counting_seek(f, pos):
+      stats.seeks += 1
+      return seek(f, pos)
+    def counting_inflate(f, pos, size):
+      stats.inflated += 1
+      return inflate(f, pos, size)
+    DecompIO._reset_decompressor = counting_reset
+    _ZlibReader.read = counting_zlib_read
+    _MappedPack.read = counting_read
+    _MappedPack.seek = counting_seek
+    _MappedPack.inflate = counting_inflate
+
+  def uninstall(self):
+    for cls, name, fn in self._originals:
+      setattr(cls, name, fn)
+
+  def snapshot(self):
+    return (self.inflated, self.read, self.seeks)
+
+
+class _CliEvents(ConsoleEvents):
+  '''``ConsoleEvents`` that also times each phase, w/ its tracemalloc peak and ``_Stats`` if enabled, for the CLI's report.'''
+
+  def __init__(self, quiet=False, trace_memory=False, stats=None):
+    super().__init__()
+    self._quiet = quiet
+    self._trace_memory = trace_memory
+    self._stats = stats
+    self._open = []
+    self.rows = [] # in start order
+
+  def event(self, kind, value=None):
+    if not self._quiet:
+      super().event(kind, value)
+    if kind==PHASE_START:
+      if self._trace_memory:
+        import tracemalloc
+        if self._open: # the parent's peak so far, before starting this phase's
+          self._open[-1]['peak'] = max(self._open[-1]['peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+      row = {'phase': '  '*len(self._open) + value, 'peak': 0, 'received': 0, 'written': (0, 0),
+             'stats': self._stats.snapshot() if self._stats else None}
+      self.rows.append(row)
+      self._open.append(row)
+    elif not self._open:
+      return
+    elif kind==BYTES:
+      self._open[-1]['received'] = value
+    elif kind==WRITTEN:
+      self._open[-1]['written'] = value
+    elif kind==PHASE_END:
+      row = self._open.pop()
+      row['ms'] = value[1]
+      if self._stats:
+        row['stats'] = tuple(b-a for a, b in zip(row['stats'], self._stats.snapshot()))
+      if self._open:
+        self._open[-1]['received'] += row['received']
+      if self._trace_memory:
+        import tracemalloc
+        row['peak'] = max(row['peak'], tracemalloc.get_traced_memory()[1])
+        if self._open:
+          self._open[-1]['peak'] = max(self._open[-1]['peak'], row['peak'])
+
+  def report(self, out=None):
+    out = out or sys.stdout
+    columns = ['phase', 'ms']
+    if self._trace_memory: columns.append('peak')
+    if self._stats: columns += ['inflated', 'read', 'seeks', 'received', 'written', 'blocks']
+    lines = [columns]
+    for row in self.rows:
+      line = [row['phase'], row.get('ms', '')]
+      if self._trace_memory: line.append(row['peak'])
+      if self._stats: line += list(row['stats']) + [row['received']] + list(row['written'])
+      lines.append([str(v) for v in line])
+    widths = [max(len(line[i]) for line in lines) for i in range(len(columns))]
+    for line in lines:
+      out.write('  '.join(v.ljust(w) if i==0 else v.rjust(w) for i, (v, w) in enumerate(zip(line, widths))).rstrip() + '\n')
+
+
+def _serve_local(path):
+  '''Serves the git repo at path over smart HTTP (w/ ``git http-backend``) on a free localhost port, for the CLI.  Returns (url, server).'''
+  import http.server, subprocess, threading
+  root, name = os.path.split(os.path.abspath(path).rstrip('/'))
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def _cgi(self, method):
+      path, _, query = self.path.partition('?')
+      body = self.rfile.read(int(self.headers.get('Content-Length') or 0)) if method=='POST' else b''
+      env = dict(os.environ, GIT_PROJECT_ROOT=root, GIT_HTTP_EXPORT_ALL='1', PATH_INFO=path, QUERY_STRING=query,
+                 REQUEST_METHOD=method, CONTENT_TYPE=self.headers.get('Content-Type', ''), CONTENT_LENGTH=str(len(body)),
+                 GIT_PROTOCOL=self.headers.get('Git-Protocol', ''))
+      p = subprocess.run(['git', 'http-backend'], input=body, env=env, capture_output=True)
+      head, _, content = p.stdout.partition(b'\r\n\r\n')
+      status, headers = 200, []
+      for line in head.decode().split('\r\n'):
+        k, _, v = line.partition(':')
+        if k.lower()=='status':
+          status = int(v.split()[0])
+        elif k:
+          headers.append((k, v.strip()))
+      self.send_response(status)
+      for k, v in headers:
+        self.send_header(k, v)
+      self.end_headers()
+      self.wfile.write(content)
+
+    def do_GET(self):
+      self._cgi('GET')
+
+    def do_POST(self):
+      self._cgi('POST')
+
+    def log_message(self, *args):
+      pass
+
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+  return f'http://127.0.0.1:{server.server_port}/{name}', server
+
+
+def _run_command(args, events, run):
+  '''
+    :param run: Called w/ the operation itself (and its arguments), so profiling can leave out the setup.
+  '''
+  repo = Repo(args.directory, events=events, workers=getattr(args, 'workers', None))
+  server = local = None
+  try:
+    if args.command=='clone':
+      url = args.source
+      if not url.startswith(('http://', 'https://')):
+        local = os.path.abspath(url)
+        url, server = _serve_local(local)
+      run(clone, url, args.directory, ref=args.ref, shallow=not args.deep, cone=args.cone, events=events, workers=args.workers)
+      return
+    if args.command in ('fetch', 'checkout'):
+      with DB(f'{repo._git_dir}/config') as config:
+        url = config[b'repo'].decode()
+        if not url.startswith(('http://', 'https://')): # a local repo, cloned w/ the CLI
+          local = url
+          url, server = _serve_local(local)
+          config[b'repo'] = url.encode()
+    if args.command=='fetch':
+      run(repo.fetch, shallow=not args.deep, ref=args.ref)
+    elif args.command=='checkout':
+      run(repo.checkout, ref=args.ref)
+    elif args.command=='status':
+      run(repo.status, ref=args.ref)
+    elif args.command=='log':
+      run(repo.log, ref=args.ref)
+  finally:
+    if server:
+      server.shutdown()
+      if _exists(f'{repo._git_dir}/config'): # the served URL dies w/ the server, so store the repo's path
+        with DB(f'{repo._git_dir}/config') as config:
+          config[b'repo'] = local.encode()
+
+
+def _main(argv=None):
+  '''``python -m ygit``: runs one command, optionally profiled, w/ a per-phase report.'''
+  import argparse
+  parser = argparse.ArgumentParser(prog='python -m ygit', description=__description__)
+  parser.add_argument('--profile', action='store_true', help='run under cProfile and print the top functions by cumulative time')
+  parser.add_argument('--trace-memory', action='store_true', help='report the tracemalloc peak of each phase')
+  parser.add_argument('--stats', action='store_true', help='report objects inflated, pack bytes read and seeks, per phase')
+  parser.add_argument('-q', '--quiet', action='store_true', help='only print the report')
+  commands = parser.add_subparsers(dest='command', metavar='command')
+  commands.required = True
+  p = commands.add_parser('clone', help='clone a URL, or a local git repo (served w/ git http-backend)')
+  p.add_argument('source')
+  p.add_argument('directory', nargs='?', default='.')
+  p.add_argument('--cone')
+  for name in ('clone', 'fetch', 'checkout', 'status', 'log'):
+    p = commands.choices.get(name) or commands.add_parser(name)
+    if name!='clone':
+      p.add_argument('directory', nargs='?', default='.')
+    p.add_argument('--ref', default='HEAD')
+    if name in ('clone', 'fetch'):
+      p.add_argument('--deep', action='store_true', help='fetch all history (not shallow)')
+      p.add_argument('--workers', type=int, help='index packs w/ this many processes')
+  args = parser.parse_args(argv)
+  if args.trace_memory and sys.version_info < (3, 9):
+    parser.error('--trace-memory needs Python 3.9+ (for tracemalloc.reset_peak())')
+
+  stats = _Stats() if args.stats else None
+  events = _CliEvents(quiet=args.quiet, trace_memory=args.trace_memory, stats=stats)
+  run = lambda fn, *args, **kwargs: fn(*args, **kwargs)
+  if args.profile:
+    import cProfile, pstats
+    profile = cProfile.Profile()
+    run = profile.runcall
+  if stats:
+    stats.install()
+  if args.trace_memory:
+    import tracemalloc
+    tracemalloc.start()
+  try:
+    with events.span('total'):
+      _run_command(args, events, run)
+  finally:
+    if stats:
+      stats.uninstall()
+    if args.trace_memory:
+      tracemalloc.stop()
+  if args.profile:
+    pstats.Stats(profile, stream=sys.stdout).sort_stats('cumulative').print_stats(30)
+  events.report()
 
 
+if __name__=='__main__':
+  _main()